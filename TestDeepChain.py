@@ -0,0 +1,91 @@
+import os
+import time
+import unittest
+import libvirt
+
+import benchmark
+import fixtures
+import utils
+
+# Chain depths to measure, BASE included
+DEPTHS = benchmark.env_list('LIVEMERGE_DEPTHS', '2,4,8,16,32,64')
+RESULTS_DIR = benchmark.RESULTS_DIR
+
+
+def setUpModule():
+    utils.patch_subprocess()
+
+
+def tearDownModule():
+    utils.destroy_domain_pool()
+    fixtures.clear_cache()
+    utils.destroy_block_pool()
+    utils.close_connection()
+
+
+class TestDeepChain(unittest.TestCase):
+    def tearDown(self):
+        utils.cleanup_images()
+
+    def _merge(self, merge, dom, paths):
+        base_file, top_file = paths[0], paths[-1]
+        if merge == 'forward':
+            # Pull every intermediate layer into the top: BASE---TOP
+            dom.blockRebase(top_file, base_file, 0, 0)
+            flags = libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_PULL
+        elif merge == 'backward-inactive':
+            # Commit every intermediate layer into BASE: BASE---TOP
+            dom.blockCommit(top_file, base_file, paths[-2], 0, 0)
+            flags = libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_COMMIT
+        else:
+            # Commit everything, the active layer included, into BASE
+            dom.blockCommit(top_file, base_file, top_file, 0,
+                            libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+            flags = libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_COMMIT
+        return utils.wait_block_job(dom, top_file, flags)
+
+    def _run(self, depth, merge):
+        layers = fixtures.chain_layers(depth)
+        paths = fixtures.get_chain(layers)
+
+        start = time.time()
+        with utils.running_vm('livemerge-test', layers[-1].name) as (dom, _):
+            vmStart = time.time() - start
+            job = self._merge(merge, dom, paths)
+
+        # After an active commit all data lives in BASE
+        verified = paths[0] if merge == 'active' else paths[-1]
+        start = time.time()
+        extents = [w for layer in layers for w in layer.writes]
+        ok = all(utils.verify_extents(verified, extents))
+        verify = time.time() - start
+        return dict(depth=depth, merge=merge, vm_start=vmStart,
+                    merge_duration=job.elapsed, verify=verify,
+                    ok=bool(job) and ok)
+
+    @unittest.skipUnless(benchmark.enabled(), "LIVEMERGE_BENCHMARK not set")
+    def test_merge_scaling(self):
+        """
+        Merge Scaling Across Chain Depth
+
+        For every depth N create image chain: BASE---S1---...---S<N-1>
+        Start VM and run each of:
+          forward:            BASE---S<N-1> (pull S1..S<N-2>)
+          backward-inactive:  BASE---S<N-1> (commit S1..S<N-2>)
+          active:             BASE          (commit S1..S<N-1>)
+        Record VM start, merge and verification times
+        """
+        table = benchmark.BenchmarkTable(
+            ['depth', 'merge', 'vm_start', 'merge_duration', 'verify', 'ok'])
+        for depth in DEPTHS:
+            for merge in ('forward', 'backward-inactive', 'active'):
+                if merge == 'backward-inactive' and depth < 3:
+                    # There is no inactive layer above BASE to commit
+                    continue
+                table.add(**self._run(depth, merge))
+                utils.cleanup_images()
+
+        print table.format()
+        table.export_csv(os.path.join(RESULTS_DIR, 'deep_chain.csv'),
+                         utils.storage_info())
+        self.assertTrue(all(row['ok'] for row in table.rows))
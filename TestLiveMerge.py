@@ -5,6 +5,10 @@ import sys
 import subprocess
 
 from testrunner import permutations, expandPermutations
+from fixtures import Layer
+import fixtures
+import integrity
+import pivot
 import utils
 
 # Create a 3-D matrix of test permutations.  It does not make sense to
@@ -21,6 +25,13 @@ def setUpModule():
     utils.patch_subprocess()
 
 
+def tearDownModule():
+    utils.destroy_domain_pool()
+    fixtures.clear_cache()
+    utils.destroy_block_pool()
+    utils.close_connection()
+
+
 @expandPermutations
 class TestLiveMerge(unittest.TestCase):
     def tearDown(self):
@@ -36,26 +47,24 @@ class TestLiveMerge(unittest.TestCase):
         Merge S1 >> S2
         Final image chain:  BASE---S2
         """
-        base_file = utils.create_image('BASE', fmt=baseFmt, block=block)
-        utils.write_image(base_file, 0, 3072, 1)
-        s1_file = utils.create_image('S1', 'BASE', relative=relPath,
-                                     backingFmt=baseFmt, block=block)
-        utils.write_image(s1_file, 1024, 2048, 2)
-        s2_file = utils.create_image('S2', 'S1', relative=relPath,
-                                     block=block)
-        utils.write_image(s2_file, 2048, 1024, 3)
-
-        dom = utils.create_vm('livemerge-test', 'S2', block=block)
-        try:
+        layers = [Layer('BASE', baseFmt, [(0, 3072, 1)]),
+                  Layer('S1', 'qcow2', [(1024, 2048, 2)]),
+                  Layer('S2', 'qcow2', [(2048, 1024, 3)])]
+        base_file, s1_file, s2_file = fixtures.get_chain(layers, relPath,
+                                                         block)
+        before = integrity.digest_image(s2_file)
+
+        vm = utils.running_vm('livemerge-test', 'S2', block=block)
+        with vm as (dom, target):
             dom.blockRebase(s2_file, base_file, 0, 0)
             flags = libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_PULL
             self.assertTrue(utils.wait_block_job(dom, s2_file, flags))
-        finally:
-            dom.destroy()
 
-        self.assertTrue(utils.verify_image(s2_file, 0, 1024, 1))
-        self.assertTrue(utils.verify_image(s2_file, 1024, 1024, 2))
-        self.assertTrue(utils.verify_image(s2_file, 2048, 1024, 3))
+        self.assertEqual(utils.verify_extents(s2_file, [(0, 1024, 1),
+                                                        (1024, 1024, 2),
+                                                        (2048, 1024, 3)]),
+                         [True, True, True])
+        self.assertEqual(integrity.verify_image(before, s2_file), [])
         self.assertTrue(utils.verify_backing_file(base_file, None))
         self.assertTrue(utils.verify_backing_file(s2_file, 'BASE',
                                                   relative=relPath,
@@ -74,16 +83,16 @@ class TestLiveMerge(unittest.TestCase):
         utils.create_image('BASE')
         utils.create_image('S1', 'BASE')
         s2_file = utils.create_image('S2', 'S1')
+        before = integrity.digest_image(s2_file)
 
-        dom = utils.create_vm('livemerge-test', 'S2', block=False)
-        try:
+        vm = utils.running_vm('livemerge-test', 'S2', block=False)
+        with vm as (dom, target):
             dom.blockRebase(s2_file, None, 0, 0)
             flags = libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_PULL
             self.assertTrue(utils.wait_block_job(dom, s2_file, flags))
-        finally:
-            dom.destroy()
 
         self.assertTrue(utils.verify_backing_file(s2_file, None))
+        self.assertEqual(integrity.verify_image(before, s2_file), [])
 
     def test_backward_merge_from_active(self):
         """
@@ -91,25 +100,26 @@ class TestLiveMerge(unittest.TestCase):
 
         Create image chain: BASE---S1---S2
         Start VM
-        Merge S1 << S2
+        Merge S1 << S2 and pivot the VM to S1
         Final image chain:  BASE---S1
         """
         base_file = utils.create_image('BASE')
         s1_file = utils.create_image('S1', 'BASE')
         s2_file = utils.create_image('S2', 'S1')
+        before = integrity.digest_image(s2_file)
 
-        dom = utils.create_vm('livemerge-test', 'S2', block=False)
-        try:
-            dom.blockCommit(s2_file, s1_file, s2_file, 0, 0)
-            flags = libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_COMMIT
-            self.assertTrue(utils.wait_block_job(dom, s2_file, flags))
-        finally:
-            dom.destroy()
+        vm = utils.running_vm('livemerge-test', 'S2', block=False)
+        with vm as (dom, target):
+            result = pivot.active_commit(dom, s2_file, s1_file, target)
+            self.assertTrue(result.ready)
+            self.assertTrue(result.pivoted)
 
         self.assertTrue(utils.verify_backing_file(base_file, None))
         self.assertTrue(utils.verify_backing_file(s1_file, 'BASE',
                                                   relative=False,
                                                   block=False))
+        # S1 now holds everything the guest saw through S2
+        self.assertEqual(integrity.verify_image(before, s1_file), [])
 
     @permutations(liveMergePermutations)
     def test_backward_merge_from_inactive(self, relPath, baseFmt, block):
@@ -121,11 +131,11 @@ class TestLiveMerge(unittest.TestCase):
         Merge BASE << S1
         Final image chain:  BASE---S2
         """
-        base_file = utils.create_image('BASE', fmt=baseFmt, block=block)
-        s1_file = utils.create_image('S1', 'BASE', relative=relPath,
-                                     backingFmt=baseFmt, block=block)
-        s2_file = utils.create_image('S2', 'S1', relative=relPath,
-                                     block=block)
+        layers = [Layer('BASE', baseFmt, []),
+                  Layer('S1', 'qcow2', []),
+                  Layer('S2', 'qcow2', [])]
+        base_file, s1_file, s2_file = fixtures.get_chain(layers, relPath,
+                                                         block)
         self.assertTrue(utils.verify_backing_file(base_file, None))
         self.assertTrue(utils.verify_backing_file(s1_file, 'BASE',
                                                   relative=relPath,
@@ -133,18 +143,18 @@ class TestLiveMerge(unittest.TestCase):
         self.assertTrue(utils.verify_backing_file(s2_file, 'S1',
                                                   relative=relPath,
                                                   block=block))
+        before = integrity.digest_image(s2_file)
 
-        dom = utils.create_vm('livemerge-test', 'S2', block=block)
-        try:
-            dom.blockCommit('vda', base_file, s1_file, 0, 0)
+        vm = utils.running_vm('livemerge-test', 'S2', block=block)
+        with vm as (dom, target):
+            dom.blockCommit(target, base_file, s1_file, 0, 0)
             flags = libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_COMMIT
             self.assertTrue(utils.wait_block_job(dom, s2_file, flags))
-        finally:
-            dom.destroy()
 
         self.assertTrue(utils.verify_backing_file(base_file, None))
         self.assertTrue(utils.verify_backing_file(s2_file, 'BASE',
                                                   relative=relPath,
                                                   block=block))
         self.assertTrue(utils.verify_image_format(base_file, baseFmt))
+        self.assertEqual(integrity.verify_image(before, s2_file), [])
 
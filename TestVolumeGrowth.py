@@ -1,112 +1,271 @@
 # Test proceedure:
-# - Create a new Fedora 20 VM in (BASE.img)
+# - Create a new Fedora 20 VM in (BASE.img) running the guest workload
 # - Create the desired Volume chain
 # - Start Monitoring all volume chain images
-#   - Once per second, collect the highest offset written
+#   - Every SAMPLE_INTERVAL seconds, collect the highest offset written
 # - Start VM
 # - Wait for active layer to grow by 100M
 # - Execute live merge operation and wait for completion
-#   - Limit bandwidth in order to exacerbate convergence
-# - Notify monitoring threads to stop and wait
-# - Print image size information
+#   - Limit bandwidth in order to exacerbate convergence (benchmark mode
+#     sweeps LIVEMERGE_BANDWIDTHS against LIVEMERGE_WRITE_RATES)
+# - Stop the sampler
+# - Print image size information and convergence analysis, and export
+#   the samples as CSV and JSON
 #
 # Test scenarios:
 # - BlockRebase BASE >> S1
 # - BlockCommit BASE << S1
 
-import threading
+import os
 import time
 import unittest
 
+import libvirt
+
+import analysis
+import benchmark
+import pivot
+import sampling
+import thinlvm
 import utils
+import workload
 
-touch_script = '''
-#!/bin/bash
-seek=0
-while true; do
-    sleep 1
-    dd if=/dev/zero of=/blob conv=notrunc bs=100M count=1 seek=$seek
-    seek=$((seek + 1))
-done
-'''
-
-class ImageWatcher(threading.Thread):
-    def __init__(self, fname, statList, stopEvent):
-        threading.Thread.__init__(self)
-        self.fname = fname
-        self.statList = statList
-        self.stopEvent = stopEvent
-
-    def work(self):
-        data = (time.time(), utils.get_image_end_offset(self.fname))
-        self.statsList.append(data)
-
-    def run(self):
-        while not self.stopEvent.is_set():
-            self.work()
-            time.sleep(1)
+# Seconds between allocation samples
+SAMPLE_INTERVAL = float(os.environ.get('LIVEMERGE_SAMPLE_INTERVAL', '0.01'))
+RESULTS_DIR = benchmark.RESULTS_DIR
+PRINT_COLUMNS = 20
+# Seconds a merge may take before it is considered not to converge
+JOB_TIMEOUT = float(os.environ.get('LIVEMERGE_JOB_TIMEOUT', '300'))
+GROWTH_BEFORE_MERGE = 100 * 1024 * 1024
+# Seconds an active commit is held in READY, mirroring guest writes, before
+# the pivot
+MIRROR_TIME = float(os.environ.get('LIVEMERGE_MIRROR_TIME', '10'))
+
+# Guest I/O, sequential 1M writes at 100 MiB/s unless overridden by the
+# LIVEMERGE_WORKLOAD_* variables
+WORKLOAD = workload.from_env()
+
+
+def tearDownModule():
+    utils.close_connection()
 
 
+def _write_rate(stats):
+    """
+    Rate the guest wrote at, measured host side over the whole run, in MiB/s
+    like the requested workload rate.
+    """
+    rate = analysis.rate(stats['io.wr_bytes'])
+    return rate / 2 ** 20 if rate is not None else None
+
+
+# Growth is driven by a guest workload, which a fake domain cannot run
+@unittest.skipIf(utils.offline(), "needs a running guest")
 class TestVolumeGrowth(unittest.TestCase):
     def tearDown(self):
         pass #utils.cleanup_images()
 
-    def _print_results(self, test, stats):
+    def _print_results(self, test, stats, result=None):
         print "%s - Results\n\n" % test
-        for label, data in stats.items():
+        for label, data in sorted(stats.items()):
+            if not data:
+                continue
             start = data[0][0]
-            print "%4s:" % label
-            times, values = zip(*data)
-            t_fmt = ["%4i" % int(t - start) for t in times].join()
-            v_fmt = ["%4i" % v for v in values].join()
-            print "%4s:%s" % (label, t_fmt)
-            print "     %s" % v_fmt
+            # Keep the table readable at high sampling rates
+            step = max(1, len(data) / PRINT_COLUMNS)
+            times, values = zip(*data[::step])
+            t_fmt = " ".join("%6.1f" % (t - start) for t in times)
+            v_fmt = " ".join("%6i" % (v / 1024 / 1024) for v in values)
+            print "%4s: %s" % (label, t_fmt)
+            print "      %s" % v_fmt
+        if result is not None:
+            print
+            for key in sorted(result):
+                print "%20s: %s" % (key, result[key])
 
+    def _export_results(self, test, stats, result):
+        if not os.path.exists(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        prefix = os.path.join(RESULTS_DIR, test)
+        context = utils.storage_info()
+        analysis.export_csv(stats, prefix + '.csv', context)
+        analysis.export_json(stats, prefix + '.json', result, context)
 
-    def test_commit(self):
-        print "Creating VM image"
+    def _run_merge(self, scenario, bandwidth=0, spec=WORKLOAD,
+                   timeout=JOB_TIMEOUT, thin=False):
+        """
+        Build a fresh guest, start it running the workload spec and run a
+        commit, pull or pivoted active commit ('pivot') limited to bandwidth
+        MiB/s (0 means unlimited).
+        With thin set the chain lives on logical volumes extended by a
+        thinlvm.WatermarkMonitor.  Returns the collected samples, the
+        wait_block_job result (a pivot.ActiveCommitResult for 'pivot'), the
+        time the job was started and the summary of the monitor, or None.
+        """
+        print "Creating VM image (%s)" % workload.describe(spec)
+        utils.cleanup_images()
         base_file = utils.get_image_path('BASE', False, False)
-        utils.build_vm('BASE', touch_script, '10G')
-        s1_file = utils.create_image('S1', 'BASE', size='10G')
+        utils.build_vm('BASE', workload.render(spec), '10G')
+        if thin:
+            base_file = thinlvm.import_image('BASE', base_file)
+        s1_file = utils.create_image('S1', 'BASE', size='10G', block=thin)
 
         # Monitor the image sizes
-        stats = {'BASE': [], 'S1': []}
-        stopEvent = threading.Event()
-        base_watcher = ImageWatcher(base_file, stats['BASE'], stopEvent)
-        base_watcher.start()
-        s1_watcher = ImageWatcher(s1_file, stats['S1'], stopEvent)
-        s1_watcher.start()
+        sampler = sampling.AllocationSampler(SAMPLE_INTERVAL)
+        sampler.add_image('BASE', base_file)
+        sampler.add_image('S1', s1_file)
+        sampler.start()
 
         # Run the test
         print "Starting VM"
-        dom = utils.create_vm('livemerge-test', 'S1')
-        # TODO: Start a livemerge
-
+        dom = utils.create_vm('livemerge-test', 'S1', block=thin)
+        sampler.add_domain('vda', dom, 'vda')
+        sampler.add_block_stats('io', dom, 'vda')
+        monitor = None
         try:
-            dom.blockCommit(s1_file, base_file, s1_file, 0, 0)
-            flags = libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_COMMIT
-            self.assertTrue(utils.wait_block_job(dom, s1_file, flags))
+            if thin:
+                pool = utils.get_block_pool()
+                monitor = thinlvm.WatermarkMonitor(dom, pool)
+                monitor.start()
+                for label, path in (('S1', s1_file), ('BASE', base_file)):
+                    monitor.watch(thinlvm.chain_target(dom, 'vda', path),
+                                  path)
+                    sampler.add(label + '.lv', lambda p=path: pool.size(p))
+            self._wait_for_growth(sampler.series('S1'), GROWTH_BEFORE_MERGE)
+            sampler.add_block_job('job', dom, s1_file)
+            jobStart = time.time()
+            if scenario == 'pivot':
+                job = pivot.active_commit(dom, s1_file, base_file, 'vda',
+                                          bandwidth, MIRROR_TIME, timeout)
+            else:
+                if scenario == 'commit':
+                    dom.blockCommit(s1_file, base_file, s1_file, bandwidth,
+                                    libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+                    flags = libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_COMMIT
+                else:
+                    dom.blockRebase(s1_file, None, bandwidth, 0)
+                    flags = libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_PULL
+                job = utils.wait_block_job(dom, s1_file, flags, timeout)
+                if not job:
+                    dom.blockJobAbort(s1_file, 0)
         finally:
+            # Stop the test
+            print "Cleaning up"
+            if monitor is not None:
+                monitor.stop()
             dom.destroy()
+            sampler.stop()
 
+        return (sampler.samples(), job, jobStart,
+                monitor.summary() if monitor is not None else None)
 
-        ## Wait until image has grown enough
-        #print "Sampling"
-        #while True:
-            #end = utils.get_image_end_offset(s1_file) / 1024 / 1024
-            #print "S1 is using %i MB" % end
-            #if end >= 5 * 1024:
-                #break
-            #time.sleep(5)
+    def _wait_for_growth(self, series, growth, timeout=600):
+        """
+        Wait until the guest workload has grown the image by growth bytes.
+        """
+        deadline = time.time() + timeout
+        start = None
+        while time.time() < deadline:
+            last = series.last()
+            if last is not None:
+                if start is None:
+                    start = last[1]
+                elif last[1] - start >= growth:
+                    return
+            time.sleep(1)
+        raise Exception("Image did not grow by %i bytes in %i seconds" %
+                        (growth, timeout))
 
-        # Stop the test
-        print "Cleaning up"
-        stopEvent.set()
-        base_watcher.join()
-        s1_watcher.join()
+    def test_commit(self):
+        stats, job, jobStart, _ = self._run_merge('commit')
 
         # Print results
-        self._print_results(stats)
+        jobEnd = jobStart + job.elapsed if job else None
+        result = analysis.analyze(stats, jobStart, jobEnd)
+        result['guest_write_rate'] = _write_rate(stats)
+        self._print_results('test_commit', stats, result)
+        self._export_results('test_commit', stats, result)
+        self.assertTrue(job)
+
+    @unittest.skipUnless(benchmark.enabled(), "LIVEMERGE_BENCHMARK not set")
+    def test_bandwidth_sweep(self):
+        """
+        Run active commit and pull across every combination of bandwidth cap
+        and guest write rate to find where commit stops converging.  The
+        other workload parameters come from WORKLOAD.
+        """
+        bandwidths = benchmark.env_list('LIVEMERGE_BANDWIDTHS', '0,8,32,128')
+        writeRates = benchmark.env_list('LIVEMERGE_WRITE_RATES', '10,50,100')
+        table = benchmark.BenchmarkTable(
+            ['scenario', 'bandwidth', 'write_rate', 'achieved_rate',
+             'converged', 'duration', 'bytes_copied', 'rounds', 'base_size',
+             's1_size'])
+
+        for scenario in ('commit', 'pull'):
+            for writeRate in writeRates:
+                for bandwidth in bandwidths:
+                    spec = WORKLOAD._replace(rate=writeRate)
+                    stats, job, jobStart, _ = self._run_merge(
+                        scenario, bandwidth, spec)
+                    progress = analysis.job_progress(stats['job.cur'],
+                                                     stats['job.end'])
+                    table.add(scenario=scenario, bandwidth=bandwidth,
+                              write_rate=writeRate,
+                              achieved_rate=_write_rate(stats),
+                              converged=bool(job),
+                              duration=job.elapsed,
+                              bytes_copied=progress['bytes_copied'],
+                              rounds=progress['rounds'],
+                              base_size=stats['BASE'][-1][1],
+                              s1_size=stats['S1'][-1][1])
+
+        print table.format()
+        table.export_csv(os.path.join(RESULTS_DIR, 'bandwidth_sweep.csv'),
+                         utils.storage_info())
+
+        # The floor is the lowest cap at which active commit still converged
+        for writeRate in writeRates:
+            converged = [r['bandwidth'] for r in table.rows
+                         if r['scenario'] == 'commit' and r['converged'] and
+                         r['write_rate'] == writeRate and r['bandwidth']]
+            print "write rate %i MiB/s: commit bandwidth floor %s MiB/s" % (
+                writeRate, min(converged) if converged else 'not found')
+
+    @unittest.skipUnless(benchmark.enabled(), "LIVEMERGE_BENCHMARK not set")
+    def test_active_commit_pivot(self):
+        """
+        Active commit under the guest workload: time to READY, MIRROR_TIME
+        seconds of mirroring, then the pivot.  Exports the pivot latency and
+        the guest I/O stall around it so that qemu and libvirt versions can
+        be compared.
+        """
+        stats, result, jobStart, _ = self._run_merge('pivot')
+        data = result._asdict()
+        data['guest_write_rate'] = _write_rate(stats)
+        self._print_results('test_active_commit_pivot', stats, data)
+        self._export_results('test_active_commit_pivot', stats, data)
+        self.assertTrue(result.ready)
+        self.assertTrue(result.pivoted)
+
+    @unittest.skipUnless(utils.block_backend() == 'thin',
+                         "LIVEMERGE_BLOCK_BACKEND is not thin")
+    def test_commit_thin(self):
+        """
+        Active commit with the chain on logical volumes that start one chunk
+        large and are extended as the guest and the job write into them.
+        Reports how long extensions took and whether the guest paused.
+        """
+        stats, job, jobStart, extension = self._run_merge('commit',
+                                                          thin=True)
+
+        jobEnd = jobStart + job.elapsed if job else None
+        result = analysis.analyze(stats, jobStart, jobEnd)
+        result['guest_write_rate'] = _write_rate(stats)
+        result.update(extension)
+        self._print_results('test_commit_thin', stats, result)
+        self._export_results('test_commit_thin', stats, result)
+        self.assertTrue(job)
+        self.assertEqual(extension['errors'], 0)
 
     def runTest(self):
         pass
@@ -0,0 +1,165 @@
+import csv
+import json
+
+
+def window(samples, start=None, end=None):
+    return [(t, v) for t, v in samples
+            if (start is None or t >= start) and (end is None or t <= end)]
+
+
+def rate(samples):
+    """
+    Least squares slope of the samples in bytes per second, or None when
+    there are not enough samples to tell.
+    """
+    if len(samples) < 2:
+        return None
+    n = float(len(samples))
+    t0 = samples[0][0]
+    meanT = sum(t - t0 for t, v in samples) / n
+    meanV = sum(v for t, v in samples) / n
+    var = sum((t - t0 - meanT) ** 2 for t, v in samples)
+    if not var:
+        return None
+    cov = sum((t - t0 - meanT) * (v - meanV) for t, v in samples)
+    return cov / var
+
+
+def value_at(samples, when):
+    """
+    Return the last sampled value at or before when, or the first value if
+    sampling started later.
+    """
+    value = samples[0][1] if samples else None
+    for t, v in samples:
+        if t > when:
+            break
+        value = v
+    return value
+
+
+def analyze(stats, jobStart, jobEnd=None, now=None, io='io', job='job'):
+    """
+    Work out whether an active commit keeps up with the guest.
+
+    The dirty rate is the rate the guest writes at, from the io.wr_bytes
+    blockStats series, and the copy rate is the rate the job copies at,
+    from its job.cur progress, both measured while the job runs.  jobEnd is
+    the time the job completed or became ready, or None if it never did;
+    in that case the remaining work is the job's end - cur at the last
+    sample and the convergence time is projected from the rates.  Guest
+    writes that land on data the job still has to copy add no work, so the
+    dirty rate is an upper bound and a projection is conservative.
+    """
+    writes = stats.get(io + '.wr_bytes', [])
+    curSamples = stats.get(job + '.cur', [])
+    endSamples = stats.get(job + '.end', [])
+    peak = dict((label, max(v for t, v in samples) if samples else None)
+                for label, samples in stats.items())
+    result = {
+        'dirty_rate': None,
+        'copy_rate': None,
+        'remaining': None,
+        'converged': jobEnd is not None,
+        'time_to_convergence': (jobEnd - jobStart
+                                if jobEnd is not None else None),
+        'projected': False,
+        'peak': peak,
+    }
+    if not writes or not curSamples or not endSamples:
+        result['reason'] = 'no samples'
+        return result
+
+    if now is None:
+        now = max(t for t, v in writes + curSamples + endSamples)
+    end = jobEnd if jobEnd is not None else now
+    dirtyRate = rate(window(writes, jobStart, end))
+    copyRate = rate(window(curSamples, jobStart, end))
+    result['dirty_rate'] = dirtyRate
+    result['copy_rate'] = copyRate
+    if jobEnd is not None:
+        return result
+
+    remaining = value_at(endSamples, now) - value_at(curSamples, now)
+    result['remaining'] = remaining
+
+    if dirtyRate is None or copyRate is None:
+        result['reason'] = 'insufficient samples'
+        return result
+
+    if copyRate <= dirtyRate:
+        # Not expected to catch up while the guest keeps writing this fast
+        result['reason'] = 'copy rate does not exceed guest write rate'
+        return result
+
+    result['projected'] = True
+    result['time_to_convergence'] = (now - jobStart +
+                                     max(remaining, 0) /
+                                     (copyRate - dirtyRate))
+    return result
+
+
+def job_progress(curSamples, endSamples):
+    """
+    Summarise block job progress samples.  Every time the job's end grows,
+    the guest dirtied data that needs another pass, so the number of
+    increases counts the convergence rounds.
+    """
+    rounds = 0
+    last = None
+    for t, v in endSamples:
+        if last and v > last:
+            rounds += 1
+        last = v
+    copied = max(v for t, v in curSamples) if curSamples else 0
+    return {'bytes_copied': copied, 'rounds': rounds}
+
+
+def longest_stall(samples, start, end):
+    """
+    Return the longest time a cumulative counter, such as the bytes a guest
+    wrote, stood still in a period overlapping start to end, or None when
+    the samples do not cover it.  Progress is only seen at sample times, so
+    the result is accurate to one sampling interval.
+    """
+    stall = None
+    changed = None
+    last = None
+    for t, v in samples:
+        if last is None or v != last:
+            if changed is not None and t >= start and changed <= end:
+                stall = max(stall, t - changed)
+            changed = t
+            last = v
+    if changed is not None and samples and changed <= end:
+        # Still stalled at the last sample
+        t = samples[-1][0]
+        if t >= start:
+            stall = max(stall, t - changed)
+    return stall
+
+
+def export_csv(stats, path, context=None):
+    """
+    Write one row per sample.  The fields of context, such as the storage
+    profile, are repeated as columns of every row.
+    """
+    context = context or {}
+    keys = sorted(context)
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['label', 'timestamp', 'value'] + keys)
+        extra = [context[k] for k in keys]
+        for label in sorted(stats):
+            for t, v in stats[label]:
+                writer.writerow([label, '%.6f' % t, v] + extra)
+
+
+def export_json(stats, path, analysis=None, context=None):
+    data = {'series': stats}
+    if analysis is not None:
+        data['analysis'] = analysis
+    if context is not None:
+        data['context'] = context
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
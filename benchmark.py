@@ -0,0 +1,67 @@
+import csv
+import os
+
+RESULTS_DIR = os.environ.get(
+    'LIVEMERGE_RESULTS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results'))
+
+
+def enabled():
+    return bool(os.environ.get('LIVEMERGE_BENCHMARK'))
+
+
+def env_list(name, default, convert=int):
+    """
+    Read a comma separated list of values from the environment.
+    """
+    value = os.environ.get(name, default)
+    return [convert(v) for v in value.split(',') if v.strip()]
+
+
+class BenchmarkTable(object):
+    """
+    Rows of benchmark measurements with a fixed set of columns, printable as
+    a text table and exportable as CSV.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.rows = []
+
+    def add(self, **row):
+        self.rows.append(row)
+
+    def _cell(self, value):
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return '%.3f' % value
+        return str(value)
+
+    def format(self):
+        cells = [[self._cell(row.get(c)) for c in self.columns]
+                 for row in self.rows]
+        widths = [max([len(c)] + [len(r[i]) for r in cells])
+                  for i, c in enumerate(self.columns)]
+        lines = ['  '.join(c.rjust(w) for c, w in zip(self.columns, widths))]
+        lines.append('  '.join('-' * w for w in widths))
+        for r in cells:
+            lines.append('  '.join(c.rjust(w) for c, w in zip(r, widths)))
+        return '\n'.join(lines)
+
+    def export_csv(self, path, context=None):
+        """
+        Write the rows to path, with the fields of context, such as the
+        storage profile, as extra columns of every row.
+        """
+        context = context or {}
+        keys = sorted(context)
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns + keys)
+            for row in self.rows:
+                writer.writerow([row.get(c) for c in self.columns] +
+                                [context[k] for k in keys])
@@ -0,0 +1,219 @@
+import os
+import re
+import subprocess
+import threading
+
+import libvirt
+
+import qcow2
+
+_PROGRESS = re.compile(r'\((\d+(?:\.\d+)?)/100%\)')
+
+
+def _backing_string(imagePath, oldBacking, newPath):
+    """
+    Keep relative chains relative: libvirt rewrites backing files in the
+    same style as the name it replaces.
+    """
+    if oldBacking and not os.path.isabs(oldBacking):
+        return os.path.relpath(newPath, os.path.dirname(imagePath))
+    return newPath
+
+
+class FakeBlockJob(object):
+    """
+    A block job carried out by qemu-img in a background thread.  Progress is
+    parsed from 'qemu-img -p' output and scaled to the virtual size of the
+    image, like qemu reports cur and end.
+    """
+
+    def __init__(self, jobType, cmd, cwd, end, active, finish=None):
+        self.type = jobType
+        self.cur = 0
+        self.end = end
+        self.active = active
+        self.ready = False
+        self.error = None
+        self._cmd = cmd
+        self._cwd = cwd
+        self._finish = finish
+        self._proc = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='fake-job')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with self._lock:
+                if self._cancelled:
+                    return
+                self._proc = subprocess.Popen(self._cmd, cwd=self._cwd,
+                                              stdout=subprocess.PIPE,
+                                              stderr=subprocess.STDOUT)
+            self._follow(self._proc.stdout)
+            if self._proc.wait() != 0:
+                if not self._cancelled:
+                    self.error = "%s failed with exit code %i" % (
+                        ' '.join(self._cmd), self._proc.returncode)
+                return
+            if self._finish is not None:
+                self._finish()
+            # Callers take cur == end as READY, so set ready first
+            self.ready = True
+            self.cur = self.end
+        except Exception, e:
+            self.error = str(e)
+
+    def _follow(self, stream):
+        # qemu-img redraws its progress line with carriage returns
+        line = []
+        while True:
+            c = stream.read(1)
+            if not c:
+                break
+            if c in '\r\n':
+                m = _PROGRESS.search(''.join(line))
+                if m:
+                    # Reaching end means READY or completed, which only
+                    # holds once qemu-img exited and finish() ran
+                    self.cur = min(int(self.end * float(m.group(1)) / 100),
+                                   max(self.end - 1, 0))
+                line = []
+            else:
+                line.append(c)
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._proc is not None and self._proc.returncode is None:
+                try:
+                    self._proc.kill()
+                except OSError:
+                    pass
+        if self._thread.ident is not None:
+            self._thread.join()
+
+    def info(self):
+        return {'type': self.type, 'bandwidth': 0, 'cur': self.cur,
+                'end': self.end}
+
+
+class FakeDomain(object):
+    """
+    Stand-in for a libvirt domain with a single disk that carries out block
+    jobs offline with qemu-img, so chain rewriting can be tested without a
+    hypervisor.  Only the calls the tests make are implemented.
+    """
+
+    def __init__(self, name, imagefile, target='vda'):
+        self._name = name
+        self._target = target
+        self._active = imagefile
+        self._job = None
+
+    def name(self):
+        return self._name
+
+    def _check_disk(self, disk):
+        if disk != self._target and (os.path.realpath(disk) !=
+                                     os.path.realpath(self._active)):
+            raise libvirt.libvirtError("invalid disk: %s" % disk)
+
+    def _start_job(self, job):
+        if self._job is not None and not self._job_finished():
+            raise libvirt.libvirtError("block job already active on disk")
+        self._job = job
+        job.start()
+
+    def _job_finished(self):
+        job = self._job
+        return job.error is not None or (job.ready and not job.active)
+
+    def blockRebase(self, disk, base, bandwidth, flags):
+        self._check_disk(disk)
+        top = self._active
+        info = qcow2.read_image_info(top, withEndOffset=False)
+        cmd = ['qemu-img', 'rebase', '-p']
+        if base:
+            baseFmt = qcow2.read_image_info(base, withEndOffset=False).format
+            cmd.extend(['-b', _backing_string(top, info.backingFile, base),
+                        '-F', baseFmt])
+        else:
+            cmd.extend(['-b', ''])
+        cmd.append(top)
+        self._start_job(FakeBlockJob(libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_PULL,
+                                     cmd, os.path.dirname(top),
+                                     info.virtualSize, active=False))
+        return 0
+
+    def blockCommit(self, disk, base, top, bandwidth, flags):
+        self._check_disk(disk)
+        chain = qcow2.backing_chain(self._active)
+        paths = [os.path.realpath(p) for p, fmt in chain]
+        top = top or self._active
+        topIndex = paths.index(os.path.realpath(top))
+        if base:
+            baseIndex = paths.index(os.path.realpath(base))
+        else:
+            baseIndex = topIndex + 1
+        basePath, baseFmt = chain[baseIndex]
+        topPath = chain[topIndex][0]
+
+        finish = None
+        if topIndex > 0:
+            # Inactive commit: the image above top now sits on base
+            child = chain[topIndex - 1][0]
+
+            def finish():
+                info = qcow2.read_image_info(child, withEndOffset=False)
+                cmd = ['qemu-img', 'rebase', '-u',
+                       '-b', _backing_string(child, info.backingFile,
+                                             basePath),
+                       '-F', baseFmt, child]
+                subprocess.check_call(cmd)
+
+        cmd = ['qemu-img', 'commit', '-p', '-b', basePath, topPath]
+        end = qcow2.read_image_info(topPath, withEndOffset=False).virtualSize
+        self._start_job(FakeBlockJob(libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_COMMIT,
+                                     cmd, os.path.dirname(topPath), end,
+                                     active=topIndex == 0, finish=finish))
+        self._commitBase = basePath
+        return 0
+
+    def blockJobInfo(self, path, flags):
+        self._check_disk(path)
+        job = self._job
+        if job is None:
+            return {}
+        if job.error is not None:
+            self._job = None
+            raise libvirt.libvirtError(job.error)
+        if job.ready and not job.active:
+            # Pull and inactive commit jobs go away once they complete
+            self._job = None
+            return {}
+        return job.info()
+
+    def blockJobAbort(self, disk, flags=0):
+        self._check_disk(disk)
+        job = self._job
+        if job is None:
+            raise libvirt.libvirtError("no active block job on disk")
+        if flags & libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT:
+            if not (job.active and job.ready):
+                raise libvirt.libvirtError("block job not ready for pivot")
+            self._active = self._commitBase
+        else:
+            job.cancel()
+        self._job = None
+        return 0
+
+    def destroy(self):
+        if self._job is not None:
+            self._job.cancel()
+            self._job = None
+        return 0
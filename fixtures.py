@@ -0,0 +1,292 @@
+import os
+import shutil
+import subprocess
+import threading
+from collections import namedtuple
+
+import timing
+import utils
+
+# One layer of an image chain.  Each layer is backed by the previous one in
+# the chain and gets its (offset, length, pattern) writes applied once it is
+# created.
+Layer = namedtuple('Layer', 'name fmt writes')
+
+COPY_CHUNK_SIZE = 1 << 20
+
+# Size of the extent each generated chain layer writes its pattern into
+CHAIN_EXTENT_SIZE = 64 * 1024
+
+# An image for ImageBuilder: created on top of the image named backing, or
+# standalone when backing is None, then written like a Layer.
+Image = namedtuple('Image', 'name backing fmt writes')
+
+# Images created or written at the same time by one ImageBuilder
+BUILD_WORKERS = int(os.environ.get('LIVEMERGE_BUILD_WORKERS', '8'))
+
+
+def chain_layers(depth, baseFmt='qcow2'):
+    """
+    Describe a chain of depth layers, BASE---S1---...---S<depth-1>, where
+    layer i writes pattern i + 1 into its own extent so that every layer's
+    data stays visible from the top.
+    """
+    layers = []
+    for i in range(depth):
+        name = 'S%i' % i if i else 'BASE'
+        writes = [(i * CHAIN_EXTENT_SIZE, CHAIN_EXTENT_SIZE, i + 1)]
+        layers.append(Layer(name, baseFmt if i == 0 else 'qcow2', writes))
+    return layers
+
+
+def chain_images(layers):
+    """
+    Convert a chain of layers, base first, into Images for ImageBuilder.
+    """
+    images = []
+    backing = None
+    for layer in layers:
+        images.append(Image(layer.name, backing, layer.fmt, layer.writes))
+        backing = layer.name
+    return images
+
+
+class ImageBuilder(object):
+    """
+    Create and write a set of images concurrently.
+
+    The images form a DAG through their backing names.  Each image is built
+    in its own thread as soon as its backing image is complete, at most
+    workers at a time, so independent chains and disks proceed in parallel
+    and the whole set takes roughly as long as its longest backing chain.
+    An image is only created once its backing image has been written since
+    qemu-img and qemu-io lock the whole chain they open.
+    """
+
+    def __init__(self, images, relative=False, block=False, imagedir=None,
+                 workers=BUILD_WORKERS):
+        self._images = dict((i.name, i) for i in images)
+        if len(self._images) != len(images):
+            raise ValueError("Duplicate image names")
+        self._order = self._sort(images)
+        self._relative = relative
+        self._block = block
+        self._imagedir = imagedir
+        self._slots = threading.Semaphore(max(1, workers))
+        self._done = dict((name, threading.Event()) for name in self._images)
+        self._paths = {}
+        self._errors = {}
+
+    def _sort(self, images):
+        # Depth first topological sort, rejecting unknown backing images and
+        # cycles which would leave builder threads waiting forever.
+        order = []
+        state = {}
+        for image in images:
+            stack = []
+            name = image.name
+            while name is not None and name not in state:
+                if name not in self._images:
+                    raise ValueError("Unknown backing image %s" % name)
+                state[name] = 'visiting'
+                stack.append(name)
+                name = self._images[name].backing
+            if name is not None and state[name] == 'visiting':
+                raise ValueError("Backing cycle through image %s" % name)
+            for name in reversed(stack):
+                state[name] = 'done'
+                order.append(name)
+        return order
+
+    def _build_one(self, image):
+        backing = image.backing
+        try:
+            if backing is not None:
+                self._done[backing].wait()
+                if backing in self._errors:
+                    raise RuntimeError("Backing image %s failed" % backing)
+                backingFmt = self._images[backing].fmt
+            else:
+                backingFmt = 'qcow2'
+            with self._slots:
+                with timing.untimed():
+                    path = utils.create_image(image.name, backing,
+                                              fmt=image.fmt,
+                                              backingFmt=backingFmt,
+                                              relative=self._relative,
+                                              block=self._block,
+                                              imagedir=self._imagedir)
+                    if image.writes and not all(
+                            utils.write_extents(path, image.writes)):
+                        raise RuntimeError("Failed to write %s" % path)
+            self._paths[image.name] = path
+        except Exception, e:
+            self._errors[image.name] = e
+        finally:
+            self._done[image.name].set()
+
+    @timing.timed(timing.IMAGE_CREATION)
+    def build(self):
+        """
+        Build every image and return {name: absolute path}.  Raises the
+        first error, in dependency order, if any image could not be built.
+        """
+        threads = []
+        for name in self._order:
+            t = threading.Thread(target=self._build_one,
+                                 args=(self._images[name],),
+                                 name='build-%s' % name)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        for name in self._order:
+            if name in self._errors:
+                raise self._errors[name]
+        return dict(self._paths)
+
+
+def build_images(images, relative=False, block=False, imagedir=None,
+                 workers=BUILD_WORKERS):
+    return ImageBuilder(images, relative, block, imagedir, workers).build()
+
+
+def _copy_sparse(src, dst):
+    # Share extents where the filesystem supports it, otherwise make sure
+    # holes stay holes.
+    cmd = ['cp', '--reflink=auto', '--sparse=always', src, dst]
+    subprocess.check_call(cmd)
+    os.chmod(dst, 0666)
+
+
+def _copy_blocks(src, dst, skipZeros, truncate):
+    """
+    Copy src into dst one chunk at a time, seeking over chunks of zeros when
+    skipZeros is set so that the destination stays sparse.
+    """
+    zeros = '\0' * COPY_CHUNK_SIZE
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'r+b' if os.path.exists(dst) else 'wb') as fdst:
+            size = 0
+            while True:
+                data = fsrc.read(COPY_CHUNK_SIZE)
+                if not data:
+                    break
+                if skipZeros and data == zeros[:len(data)]:
+                    fdst.seek(len(data), os.SEEK_CUR)
+                else:
+                    fdst.write(data)
+                size += len(data)
+            if truncate:
+                fdst.truncate(size)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+
+
+def _rebase_unsafe(imagefile, backingfile, backingFmt):
+    cmd = ['qemu-img', 'rebase', '-u', '-b', backingfile, '-F', backingFmt,
+           imagefile]
+    outf = open('/dev/null', 'w')
+    try:
+        subprocess.check_call(cmd, stdout=outf, stderr=outf)
+    finally:
+        outf.close()
+
+
+class ChainCache(object):
+    """
+    Build each distinct image chain once per session and hand out fresh
+    copies of it.
+
+    Chains are keyed by their layers (names, formats and written patterns)
+    together with the relative and block flags.  The golden copy lives in a
+    directory next to utils.IMAGEDIR so that cleanup_images() leaves it
+    alone.  Block chains are stored as sparse copies of their devices and
+    copied onto devices leased from the loop device pool.
+    """
+
+    def __init__(self):
+        self._chains = {}
+        self._lock = threading.Lock()
+
+    def _cachedir(self):
+        return utils.IMAGEDIR + '.cache'
+
+    def get(self, layers, relative=False, block=False):
+        """
+        Return the absolute paths of a fresh copy of the chain described by
+        layers, ordered from base to top.
+        """
+        layers = tuple(Layer(l.name, l.fmt, tuple(l.writes)) for l in layers)
+        key = (layers, relative, block)
+        with self._lock:
+            chaindir = self._chains.get(key)
+            if chaindir is None:
+                chaindir = os.path.join(self._cachedir(),
+                                        str(len(self._chains)))
+                self._build(chaindir, layers, relative, block)
+                self._chains[key] = chaindir
+        return self._clone(chaindir, layers, relative, block)
+
+    def _build(self, chaindir, layers, relative, block):
+        build_images(chain_images(layers), relative, block, chaindir)
+
+        if block:
+            # Keep a sparse copy of each device and return it to the pool,
+            # the clones lease their own devices.
+            pool = utils.get_block_pool()
+            for layer in layers:
+                dev = utils._blockdevs.pop(layer.name)
+                _copy_blocks(dev, os.path.join(chaindir,
+                                               "%s.img" % layer.name),
+                             skipZeros=True, truncate=True)
+                pool.release(dev)
+
+    def _clone(self, chaindir, layers, relative, block):
+        if not os.path.exists(utils.IMAGEDIR):
+            os.makedirs(utils.IMAGEDIR, 0755)
+
+        paths = []
+        for i, layer in enumerate(layers):
+            src = os.path.join(chaindir, "%s.img" % layer.name)
+            if block:
+                pool = utils.get_block_pool()
+                dev = pool.lease(os.path.getsize(src))
+                _copy_blocks(src, dev, skipZeros=pool.zeroed(dev),
+                             truncate=False)
+                utils._blockdevs[layer.name] = dev
+            else:
+                _copy_sparse(src, os.path.join(utils.IMAGEDIR,
+                                               "%s.img" % layer.name))
+            path = utils.get_image_path(layer.name, False, block)
+
+            # Relative backing files already resolve inside the new
+            # directory, absolute ones still point into the cache.
+            if i > 0 and not relative:
+                parent = layers[i - 1]
+                _rebase_unsafe(path,
+                               utils.get_image_path(parent.name, False,
+                                                    block),
+                               parent.fmt)
+            paths.append(path)
+        return paths
+
+    def clear(self):
+        with self._lock:
+            self._chains = {}
+            cachedir = self._cachedir()
+            if os.path.exists(cachedir):
+                shutil.rmtree(cachedir)
+
+
+_chainCache = ChainCache()
+
+
+@timing.timed(timing.SETUP)
+def get_chain(layers, relative=False, block=False):
+    return _chainCache.get(layers, relative, block)
+
+
+def clear_cache():
+    _chainCache.clear()
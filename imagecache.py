@@ -0,0 +1,218 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import time
+
+import qcow2
+
+CACHE_DIR = os.environ.get(
+    'LIVEMERGE_IMAGE_CACHE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+
+# Local virt-builder repository index, e.g. file:///srv/templates/index, for
+# building without network access
+TEMPLATE_SOURCE = os.environ.get('LIVEMERGE_TEMPLATE_SOURCE')
+# Set when the templates of TEMPLATE_SOURCE are not signed
+SKIP_SIGNATURE = bool(os.environ.get('LIVEMERGE_TEMPLATE_NO_SIGNATURE'))
+
+COPY = 'copy'
+OVERLAY = 'overlay'
+
+
+def image_key(template, size, password, script):
+    """
+    Content address of a built guest image.
+    """
+    scriptHash = hashlib.sha1(script or '').hexdigest()
+    data = json.dumps([template, str(size), password, scriptHash])
+    return hashlib.sha1(data).hexdigest()
+
+
+class GuestImageCache(object):
+    """
+    Guest images built by virt-builder, stored once per distinct template,
+    size, root password and firstboot script and handed out as cheap copies
+    or as overlays on top of the cached image.
+
+    Entries are evicted least recently used first once the cache grows over
+    maxSize bytes.  Concurrent test processes share the cache through a lock
+    file, and cached images are read-only so that overlays can never modify
+    them.  Overlays handed out are recorded with their cached image, which
+    is not evicted while any of them still uses it.
+    """
+
+    def __init__(self, directory=CACHE_DIR, maxSize=None, source=None,
+                 checkSignature=True):
+        self._dir = directory
+        self._maxSize = maxSize
+        self._source = source
+        self._checkSignature = checkSignature
+
+    def _path(self, key, ext):
+        return os.path.join(self._dir, '%s.%s' % (key, ext))
+
+    def _lock(self):
+        try:
+            os.makedirs(self._dir, 0755)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd = os.open(os.path.join(self._dir, '.lock'),
+                     os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def build(self, template, size, password, script, dest):
+        """
+        Build a guest image into dest with virt-builder.
+        """
+        cmd = ['virt-builder', template, '--size', str(size), '-o', dest,
+               '--format', 'qcow2', '--root-password',
+               'password:%s' % password]
+        if self._source:
+            cmd.extend(['--source', self._source])
+        if not self._checkSignature:
+            cmd.append('--no-check-signature')
+        scriptFile = dest + '.firstboot'
+        if script:
+            with open(scriptFile, 'w') as f:
+                f.write(script)
+            cmd.extend(['--firstboot', scriptFile])
+
+        try:
+            env = os.environ.copy()
+            env['LIBGUESTFS_BACKEND'] = 'direct'
+            subprocess.check_call(cmd, env=env)
+        finally:
+            if script:
+                os.unlink(scriptFile)
+
+    def get(self, template, size, password, script, dest, mode=COPY):
+        """
+        Create dest from the cached image, building it first if needed.
+        """
+        key = image_key(template, size, password, script)
+        image = self._path(key, 'qcow2')
+        fd = self._lock()
+        try:
+            if not os.path.exists(image):
+                tmp = self._path(key, 'tmp')
+                try:
+                    self.build(template, size, password, script, tmp)
+                except:
+                    if os.path.exists(tmp):
+                        os.unlink(tmp)
+                    raise
+                os.chmod(tmp, 0444)
+                with open(self._path(key, 'json'), 'w') as f:
+                    json.dump({'template': template, 'size': str(size),
+                               'script': hashlib.sha1(script or
+                                                      '').hexdigest(),
+                               'created': time.time()}, f)
+                os.rename(tmp, image)
+            # The modification time orders entries for eviction
+            os.utime(image, None)
+            self._materialize(image, dest, mode)
+            if mode == OVERLAY:
+                meta = self._meta(image)
+                meta.setdefault('overlays', []).append(
+                    os.path.abspath(dest))
+                self._writeMeta(image, meta)
+            self._evict(keep=image)
+        finally:
+            self._unlock(fd)
+        return dest
+
+    def _materialize(self, image, dest, mode):
+        if mode == OVERLAY:
+            cmd = ['qemu-img', 'create', '-f', 'qcow2', '-b', image,
+                   '-F', 'qcow2', dest]
+        elif mode == COPY:
+            cmd = ['cp', '--reflink=auto', '--sparse=always', image, dest]
+        else:
+            raise ValueError("Invalid cache mode: %s" % mode)
+        with open('/dev/null', 'w') as outf:
+            subprocess.check_call(cmd, stdout=outf)
+        os.chmod(dest, 0666)
+
+    def _metaPath(self, image):
+        return image[:-len('qcow2')] + 'json'
+
+    def _meta(self, image):
+        try:
+            with open(self._metaPath(image)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _writeMeta(self, image, meta):
+        with open(self._metaPath(image), 'w') as f:
+            json.dump(meta, f)
+
+    def _in_use(self, image):
+        """
+        Return whether an overlay handed out from image still backs onto it,
+        forgetting overlays that were removed or recreated since.
+        """
+        meta = self._meta(image)
+        overlays = []
+        for path in meta.get('overlays', []):
+            try:
+                info = qcow2.read_image_info(path, withEndOffset=False)
+            except (IOError, OSError, ValueError):
+                continue
+            if info.backingFile == image:
+                overlays.append(path)
+        if overlays != meta.get('overlays', []):
+            meta['overlays'] = overlays
+            self._writeMeta(image, meta)
+        return bool(overlays)
+
+    def entries(self):
+        """
+        Return [(mtime, allocated bytes, path)] of the cached images, least
+        recently used first.
+        """
+        entries = []
+        for name in os.listdir(self._dir):
+            if not name.endswith('.qcow2'):
+                continue
+            st = os.stat(os.path.join(self._dir, name))
+            entries.append((st.st_mtime, st.st_blocks * 512,
+                            os.path.join(self._dir, name)))
+        entries.sort()
+        return entries
+
+    def _evict(self, keep):
+        if self._maxSize is None:
+            return
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self._maxSize:
+                break
+            if path == keep or self._in_use(path):
+                continue
+            os.unlink(path)
+            meta = self._metaPath(path)
+            if os.path.exists(meta):
+                os.unlink(meta)
+            total -= size
+
+    def clear(self):
+        fd = self._lock()
+        try:
+            for mtime, size, path in self.entries():
+                os.unlink(path)
+                meta = path[:-len('qcow2')] + 'json'
+                if os.path.exists(meta):
+                    os.unlink(meta)
+        finally:
+            self._unlock(fd)
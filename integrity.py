@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+import qcow2
+import timing
+
+# Bytes read from an image at a time
+BUFFER_SIZE = 4 << 20
+WORKERS = int(os.environ.get('LIVEMERGE_VERIFY_WORKERS', '4'))
+
+
+class ImageDigest(object):
+    """
+    Digests of the guest visible data of an image, one per cluster.  Zero
+    clusters have no digest, so images whose data is allocated differently
+    but reads back the same compare equal.
+    """
+
+    def __init__(self, path, clusterSize, virtualSize, digests):
+        self.path = path
+        self.clusterSize = clusterSize
+        self.virtualSize = virtualSize
+        self.digests = digests
+
+    def cluster_length(self, cluster):
+        start = cluster * self.clusterSize
+        return min(self.clusterSize, self.virtualSize - start)
+
+    def mismatches(self, other):
+        """
+        Return the sorted guest offsets of the clusters that differ.
+        """
+        if (other.clusterSize != self.clusterSize or
+                other.virtualSize != self.virtualSize):
+            raise ValueError("Cannot compare %s and %s: geometry differs" %
+                             (self.path, other.path))
+        clusters = set(self.digests) | set(other.digests)
+        return sorted(c * self.clusterSize for c in clusters
+                      if self.digests.get(c) != other.digests.get(c))
+
+
+def map_image(path, fmt):
+    """
+    Return the extents reported by 'qemu-img map --output=json'.
+    """
+    cmd = ['qemu-img', 'map', '--output=json', '-f', fmt, path]
+    return json.loads(subprocess.check_output(cmd))
+
+
+def _data_pieces(path):
+    """
+    Return the allocated, non zero ranges of the guest visible data of path
+    as (guest offset, length, file, file offset), read from whichever layer
+    of the chain holds them.
+    """
+    chain = qcow2.backing_chain(path)
+    pieces = []
+    for e in map_image(path, chain[0][1]):
+        if not e['data'] or e['zero']:
+            continue
+        if 'offset' not in e:
+            # Compressed or encrypted clusters cannot be read in place
+            raise ValueError("No host offset for %s+%s of %s" %
+                             (e['start'], e['length'], path))
+        pieces.append((e['start'], e['length'], chain[e['depth']][0],
+                       e['offset']))
+    return pieces
+
+
+def _chunks(pieces, clusterSize):
+    # Split pieces into reads of at most BUFFER_SIZE that start on cluster
+    # boundaries wherever the piece allows it
+    bufferSize = max(clusterSize, BUFFER_SIZE - BUFFER_SIZE % clusterSize)
+    for start, length, fname, offset in pieces:
+        end = start + length
+        while start < end:
+            boundary = (start // bufferSize + 1) * bufferSize
+            n = min(end, boundary) - start
+            yield start, n, fname, offset
+            start += n
+            offset += n
+
+
+def _hash_chunk(args):
+    """
+    Read one chunk and hash the clusters it covers completely.  Returns
+    {cluster: digest} and the (cluster, offset in cluster, data) fragments
+    of clusters it only covers in part.
+    """
+    start, length, fname, offset, clusterSize, virtualSize = args
+    with open(fname, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    if len(data) != length:
+        raise IOError("Short read of %s at %i" % (fname, offset))
+
+    digests = {}
+    fragments = []
+    pos = 0
+    while pos < length:
+        cluster, inCluster = divmod(start + pos, clusterSize)
+        clusterLen = min(clusterSize, virtualSize - cluster * clusterSize)
+        n = min(length - pos, clusterLen - inCluster)
+        if n == clusterLen:
+            digests[cluster] = hashlib.sha1(data[pos:pos + n]).hexdigest()
+        else:
+            fragments.append((cluster, inCluster, data[pos:pos + n]))
+        pos += n
+    return digests, fragments
+
+
+@timing.timed(timing.VERIFY)
+def digest_image(path, clusterSize=None, workers=WORKERS):
+    """
+    Digest the guest visible data of path, hashing allocated ranges in
+    parallel and skipping unallocated and zero extents.
+    """
+    info = qcow2.read_image_info(path, withEndOffset=False)
+    clusterSize = clusterSize or info.clusterSize or 64 * 1024
+    args = [chunk + (clusterSize, info.virtualSize)
+            for chunk in _chunks(_data_pieces(path), clusterSize)]
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        results = pool.map(_hash_chunk, args)
+    finally:
+        pool.close()
+        pool.join()
+
+    result = ImageDigest(path, clusterSize, info.virtualSize, {})
+    partial = {}
+    for digests, fragments in results:
+        result.digests.update(digests)
+        for cluster, inCluster, data in fragments:
+            partial.setdefault(cluster, []).append((inCluster, data))
+    for cluster, parts in partial.iteritems():
+        buf = bytearray(result.cluster_length(cluster))
+        for inCluster, data in parts:
+            buf[inCluster:inCluster + len(data)] = data
+        result.digests[cluster] = hashlib.sha1(buf).hexdigest()
+
+    # Allocated clusters of zeros read back like holes
+    zeros = {}
+    for cluster, digest in result.digests.items():
+        n = result.cluster_length(cluster)
+        if n not in zeros:
+            zeros[n] = hashlib.sha1('\0' * n).hexdigest()
+        if digest == zeros[n]:
+            del result.digests[cluster]
+    return result
+
+
+def verify_image(before, path):
+    """
+    Digest path again and return the guest offsets of the clusters whose
+    data differs from the before digest.
+    """
+    return before.mismatches(digest_image(path, before.clusterSize))
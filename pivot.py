@@ -0,0 +1,100 @@
+import time
+from collections import namedtuple
+
+import libvirt
+
+import analysis
+import sampling
+import timing
+import utils
+
+# Seconds between blockStats samples taken around the pivot
+STALL_SAMPLE_INTERVAL = 0.005
+# Seconds of guest I/O sampled before and after the pivot
+STALL_MARGIN = 0.5
+
+# Measurements of one active commit:
+#   ready:          the job reached READY
+#   time_to_ready:  seconds from starting the job to READY
+#   mirror_hold:    seconds the job was held in READY, mirroring guest
+#                   writes, before the pivot; a configured delay, not a
+#                   measure of how fast the mirror converges
+#   mirror_lag_max: most bytes the mirror fell behind while READY
+#   pivoted:        the pivot succeeded
+#   pivot_latency:  seconds the pivot call took
+#   io_stall:       longest time guest I/O made no progress around the
+#                   pivot, None without blockStats samples
+ActiveCommitResult = namedtuple(
+    'ActiveCommitResult', 'ready time_to_ready mirror_hold mirror_lag_max '
+                          'pivoted pivot_latency io_stall')
+
+
+def _io_bytes(dom, disk):
+    # virDomainBlockStats returns (rd_req, rd_bytes, wr_req, wr_bytes, errs)
+    def read():
+        stats = dom.blockStats(disk)
+        return stats[1] + stats[3]
+    return read
+
+
+def _mirror(dom, path, duration, interval=0.1):
+    """
+    Hold the job in READY for duration seconds and return the most bytes
+    the mirror fell behind the guest meanwhile.
+    """
+    lag = 0
+    deadline = time.time() + duration
+    while True:
+        info = dom.blockJobInfo(path, 0)
+        if info:
+            lag = max(lag, info['end'] - info['cur'])
+        if time.time() >= deadline:
+            return lag
+        time.sleep(min(interval, max(0, deadline - time.time())))
+
+
+def active_commit(dom, path, base, disk='vda', bandwidth=0, mirrorHold=0,
+                  timeout=60.0):
+    """
+    Commit the active layer path into base, hold the job in READY for
+    mirrorHold seconds, and pivot the guest to base.  Convergence is
+    measured by time_to_ready; the hold only lets guest writes exercise the
+    mirror before the pivot.  Guest I/O
+    on disk is sampled around the pivot to find how long it stalled.  A job
+    that never gets READY is aborted.
+    """
+    dom.blockCommit(path, base, path, bandwidth,
+                    libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+    job = utils.wait_block_job(dom, path,
+                               libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_COMMIT,
+                               timeout)
+    if not job:
+        dom.blockJobAbort(path, 0)
+        return ActiveCommitResult(False, None, None, None, False, None, None)
+
+    with timing.phase(timing.JOB):
+        holdStart = time.time()
+        lag = _mirror(dom, path, mirrorHold)
+        mirrorHold = time.time() - holdStart
+
+        sampler = sampling.AllocationSampler(STALL_SAMPLE_INTERVAL)
+        sampler.add('io', _io_bytes(dom, disk))
+        sampler.start()
+        try:
+            time.sleep(STALL_MARGIN)
+            pivotStart = time.time()
+            try:
+                dom.blockJobAbort(path,
+                                  libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+                pivoted = True
+            except libvirt.libvirtError:
+                pivoted = False
+            pivotEnd = time.time()
+            time.sleep(STALL_MARGIN)
+        finally:
+            sampler.stop()
+
+    stall = analysis.longest_stall(sampler.samples()['io'], pivotStart,
+                                   pivotEnd)
+    return ActiveCommitResult(True, job.elapsed, mirrorHold, lag, pivoted,
+                              pivotEnd - pivotStart, stall)
@@ -0,0 +1,131 @@
+import cProfile
+import glob
+import os
+import pstats
+import re
+
+from nose.plugins import Plugin
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'results', 'profiles')
+DEFAULT_TOP = 25
+
+# Built-in functions in which the harness only waits: on libvirtd and qemu
+# through libvirt, on qemu-img and other child processes, or on its own
+# helper threads and sleeps.
+WAIT_FUNCTIONS = re.compile(
+    r"<libvirtmod\.|<time\.sleep>|<posix\.(waitpid|read)>|<select\.|"
+    r"'acquire' of 'thread\.lock'|'(read|readline)' of 'file'|"
+    r"'(poll|select)' of ")
+
+# Workers of a parallel run learn about profiling from the environment
+_DIR_ENV = 'LIVEMERGE_PROFILE_DIR'
+_MATCH_ENV = 'LIVEMERGE_PROFILE_MATCH'
+
+
+def _filename(testId):
+    return re.sub(r'[^\w.()=,-]+', '_', testId) + '.pstats'
+
+
+def start(testId):
+    """
+    Start profiling testId if profiling is enabled and the test is selected.
+    Returns the profiler to pass to stop(), or None.
+    """
+    if not os.environ.get(_DIR_ENV):
+        return None
+    match = os.environ.get(_MATCH_ENV)
+    if match and not re.search(match, testId):
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop(profiler, testId):
+    if profiler is None:
+        return
+    profiler.disable()
+    profiler.dump_stats(os.path.join(os.environ[_DIR_ENV],
+                                     _filename(testId)))
+
+
+def split(stats):
+    """
+    Split the profiled time of a pstats.Stats into (waiting, harness)
+    seconds by the internal time of the functions it was spent in.
+    """
+    waiting = harness = 0.0
+    for (fname, line, func), (cc, nc, tt, ct, callers) in \
+            stats.stats.iteritems():
+        if fname == '~' and WAIT_FUNCTIONS.search(func):
+            waiting += tt
+        else:
+            harness += tt
+    return waiting, harness
+
+
+class TestProfiler(Plugin):
+    """
+    Profile each test with cProfile, dump its stats to
+    <profile dir>/<test id>.pstats and report the hottest functions of all
+    profiled tests together.  Only the thread running the test is profiled;
+    time it spends waiting on helper threads counts as waiting.
+    """
+    name = 'profile-tests'
+    enabled = False
+
+    def options(self, parser, env):
+        parser.add_option('--profile-tests', action='store_true',
+                          dest='profileTests', default=False,
+                          help='Profile each test with cProfile')
+        parser.add_option('--profile-dir', dest='profileDir',
+                          default=PROFILE_DIR,
+                          help='Directory for the per test .pstats files')
+        parser.add_option('--profile-match', dest='profileMatch',
+                          default=None,
+                          help='Only profile tests whose id matches this '
+                               'regular expression')
+        parser.add_option('--profile-top', dest='profileTop', type='int',
+                          default=DEFAULT_TOP,
+                          help='Number of functions in the report')
+
+    def configure(self, options, conf):
+        self.conf = conf
+        self.enabled = options.profileTests
+        if not self.enabled:
+            return
+        self.top = options.profileTop
+        self.dir = options.profileDir
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        for fname in glob.glob(os.path.join(self.dir, '*.pstats')):
+            os.unlink(fname)
+        os.environ[_DIR_ENV] = self.dir
+        if options.profileMatch:
+            os.environ[_MATCH_ENV] = options.profileMatch
+        self._profilers = {}
+
+    def startTest(self, test):
+        self._profilers[test.id()] = start(test.id())
+
+    def stopTest(self, test):
+        stop(self._profilers.pop(test.id(), None), test.id())
+
+    def report(self, stream):
+        files = glob.glob(os.path.join(self.dir, '*.pstats'))
+        if not files:
+            return
+        stats = pstats.Stats(*files, stream=stream)
+        waiting, harness = split(stats)
+        total = (waiting + harness) or 1.0
+        stream.writeln()
+        stream.writeln('Profiled %i tests, stats in %s' % (len(files),
+                                                           self.dir))
+        stream.writeln('  waiting  %9.3fs  %5.1f%%' %
+                       (waiting, 100 * waiting / total))
+        stream.writeln('  harness  %9.3fs  %5.1f%%' %
+                       (harness, 100 * harness / total))
+        # Do not list every .pstats file above the table
+        stats.files = []
+        stats.sort_stats('tottime').print_stats(self.top)
@@ -0,0 +1,234 @@
+import os
+import stat
+import struct
+import threading
+
+QCOW_MAGIC = 'QFI\xfb'
+
+# Header extension types
+EXT_END = 0x00000000
+EXT_BACKING_FORMAT = 0xE2792ACA
+
+# Fields common to all qcow2 versions (72 bytes) followed by the version 3
+# additions (32 bytes).
+_HEADER_V2 = struct.Struct('>4sIQIIQIIQQIIQ')
+_HEADER_V3 = struct.Struct('>QQQII')
+_EXT_HEADER = struct.Struct('>II')
+
+# Enough to cover the header, its extensions and the backing file name in
+# all but the most unusual images.
+HEADER_READ_SIZE = 4096
+
+_cache = {}
+_cacheLock = threading.Lock()
+
+
+class ImageInfo(object):
+    def __init__(self, format, backingFile=None, backingFormat=None,
+                 clusterSize=None, virtualSize=None, endOffset=None,
+                 l1Size=0, l1TableOffset=0):
+        self.format = format
+        self.backingFile = backingFile
+        self.backingFormat = backingFormat
+        self.clusterSize = clusterSize
+        self.virtualSize = virtualSize
+        self.endOffset = endOffset
+        self.l1Size = l1Size
+        self.l1TableOffset = l1TableOffset
+
+    def __repr__(self):
+        return ("ImageInfo(format=%r, backingFile=%r, backingFormat=%r, "
+                "clusterSize=%r, virtualSize=%r, endOffset=%r)" %
+                (self.format, self.backingFile, self.backingFormat,
+                 self.clusterSize, self.virtualSize, self.endOffset))
+
+
+class Header(object):
+    def __init__(self, buf):
+        (magic, self.version, self.backingFileOffset, self.backingFileSize,
+         self.clusterBits, self.size, self.cryptMethod, self.l1Size,
+         self.l1TableOffset, self.refcountTableOffset,
+         self.refcountTableClusters, self.nbSnapshots,
+         self.snapshotsOffset) = _HEADER_V2.unpack_from(buf)
+        if magic != QCOW_MAGIC:
+            raise ValueError("Not a qcow2 image")
+        if self.version < 2:
+            raise ValueError("Unsupported qcow version %i" % self.version)
+        if self.version >= 3:
+            (self.incompatibleFeatures, self.compatibleFeatures,
+             self.autoclearFeatures, self.refcountOrder,
+             self.headerLength) = _HEADER_V3.unpack_from(buf,
+                                                         _HEADER_V2.size)
+        else:
+            self.refcountOrder = 4
+            self.headerLength = _HEADER_V2.size
+        self.clusterSize = 1 << self.clusterBits
+
+
+def _pread(fd, offset, length):
+    os.lseek(fd, offset, os.SEEK_SET)
+    chunks = []
+    while length > 0:
+        data = os.read(fd, length)
+        if not data:
+            break
+        chunks.append(data)
+        length -= len(data)
+    return ''.join(chunks)
+
+
+def _device_size(fd):
+    # Works for both regular files and block devices
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def _read_extensions(buf, header):
+    backingFormat = None
+    offset = header.headerLength
+    while offset + _EXT_HEADER.size <= len(buf):
+        extType, extLen = _EXT_HEADER.unpack_from(buf, offset)
+        offset += _EXT_HEADER.size
+        if extType == EXT_END:
+            break
+        if extType == EXT_BACKING_FORMAT:
+            backingFormat = buf[offset:offset + extLen]
+        # Extension data is padded to a multiple of 8 bytes
+        offset += (extLen + 7) & ~7
+    return backingFormat
+
+
+def _read_backing_file(fd, buf, header):
+    if not header.backingFileOffset:
+        return None
+    start = header.backingFileOffset
+    end = start + header.backingFileSize
+    if end <= len(buf):
+        return buf[start:end]
+    return _pread(fd, start, header.backingFileSize)
+
+
+def _end_offset(fd, header):
+    """
+    Compute the offset just past the last cluster in use, the same value
+    that 'qemu-img check' reports as 'Image end offset'.
+    """
+    clusterSize = header.clusterSize
+    refcountBits = 1 << header.refcountOrder
+    entriesPerBlock = clusterSize * 8 / refcountBits
+
+    table = _pread(fd, header.refcountTableOffset,
+                   header.refcountTableClusters * clusterSize)
+    blocks = struct.unpack('>%iQ' % (len(table) / 8), table)
+
+    # Scan from the end: only the last populated refcount block matters
+    for index in xrange(len(blocks) - 1, -1, -1):
+        blockOffset = blocks[index] & ~(clusterSize - 1)
+        if not blockOffset:
+            continue
+        block = _pread(fd, blockOffset, clusterSize)
+        last = _last_used_entry(block, refcountBits)
+        if last is None:
+            continue
+        return (index * entriesPerBlock + last + 1) * clusterSize
+    return 0
+
+
+def _last_used_entry(block, refcountBits):
+    if refcountBits >= 8:
+        width = refcountBits / 8
+        stripped = block.rstrip('\0')
+        if not stripped:
+            return None
+        return (len(stripped) - 1) / width
+    perByte = 8 / refcountBits
+    stripped = block.rstrip('\0')
+    if not stripped:
+        return None
+    lastByte = len(stripped) - 1
+    value = ord(stripped[-1])
+    mask = (1 << refcountBits) - 1
+    # Sub-byte refcounts are stored with the first entry in the low bits
+    for i in xrange(perByte - 1, -1, -1):
+        if (value >> (i * refcountBits)) & mask:
+            return lastByte * perByte + i
+
+
+def _read_info(fd, withEndOffset):
+    buf = _pread(fd, 0, HEADER_READ_SIZE)
+    if not buf.startswith(QCOW_MAGIC):
+        size = _device_size(fd)
+        return ImageInfo('raw', virtualSize=size, endOffset=size)
+
+    header = Header(buf)
+    info = ImageInfo('qcow2',
+                     backingFile=_read_backing_file(fd, buf, header),
+                     backingFormat=_read_extensions(buf, header),
+                     clusterSize=header.clusterSize,
+                     virtualSize=header.size,
+                     l1Size=header.l1Size,
+                     l1TableOffset=header.l1TableOffset)
+    if withEndOffset:
+        info.endOffset = _end_offset(fd, header)
+    return info
+
+
+def read_image_info(path, withEndOffset=True):
+    """
+    Parse the image metadata in-process instead of forking qemu-img.
+
+    Results for regular files are cached by (path, size, mtime) so that
+    verifying an unchanged image only costs a stat.  Block devices do not
+    reflect writes in their stat data and are therefore always read.
+    """
+    st = os.stat(path)
+    key = None
+    if stat.S_ISREG(st.st_mode):
+        key = (path, st.st_size, st.st_mtime)
+        with _cacheLock:
+            cachedKey, info = _cache.get(path, (None, None))
+        if cachedKey == key and (info.endOffset is not None or
+                                 not withEndOffset):
+            return info
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        info = _read_info(fd, withEndOffset)
+    finally:
+        os.close(fd)
+
+    if key is not None:
+        with _cacheLock:
+            # Only the latest version of each image is worth keeping
+            _cache[path] = (key, info)
+    return info
+
+
+def clear_cache():
+    with _cacheLock:
+        _cache.clear()
+
+
+def resolve_backing(imagePath, backingFile):
+    """
+    Turn a backing file name as stored in an image into a path; relative
+    names are relative to the directory of the image referencing them.
+    """
+    if os.path.isabs(backingFile):
+        return backingFile
+    return os.path.join(os.path.dirname(imagePath), backingFile)
+
+
+def backing_chain(path):
+    """
+    Return [(path, format), ...] for path and each of its backing files,
+    top first.
+    """
+    chain = []
+    while path is not None:
+        info = read_image_info(path, withEndOffset=False)
+        chain.append((path, info.format))
+        if info.backingFile:
+            path = resolve_backing(path, info.backingFile)
+        else:
+            path = None
+    return chain
@@ -0,0 +1,360 @@
+"""
+Store of test results across runs, and comparison of runs.
+
+Usage:
+    python resultsdb.py [--db PATH] list
+    python resultsdb.py [--db PATH] compare BASELINE CANDIDATE
+        [--metric total|throughput|<phase>] [--alpha 0.05]
+
+BASELINE and CANDIDATE are run ids, or comma separated lists of run ids to
+compare repeated runs.
+"""
+import argparse
+import math
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+
+import timing
+
+DEFAULT_PATH = os.environ.get(
+    'LIVEMERGE_RESULTS_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                 'results.db'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL,
+    host TEXT,
+    kernel TEXT,
+    qemu TEXT,
+    libvirt TEXT,
+    storage TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run INTEGER REFERENCES runs(id),
+    test TEXT,
+    status TEXT,
+    total REAL,
+    job_bytes INTEGER,
+    throughput REAL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run INTEGER REFERENCES runs(id),
+    test TEXT,
+    phase TEXT,
+    seconds REAL
+);
+CREATE INDEX IF NOT EXISTS results_test ON results(test);
+'''
+
+# Metrics where a larger value is better
+HIGHER_IS_BETTER = ('throughput',)
+
+
+def _version(number):
+    # libvirt encodes versions as major * 1000000 + minor * 1000 + release
+    return '%i.%i.%i' % (number / 1000000, number / 1000 % 1000,
+                         number % 1000)
+
+
+def versions():
+    """
+    Describe the host, the storage profile and the qemu and libvirt
+    versions under test.
+    """
+    # Only needed to record a run, so that stored results can be listed
+    # and compared without the libvirt bindings
+    import libvirt
+    import utils
+    try:
+        qemu = subprocess.check_output(['qemu-img', '--version'])
+        qemu = qemu.splitlines()[0].strip()
+    except (OSError, subprocess.CalledProcessError):
+        qemu = None
+    return {'host': platform.node(), 'kernel': platform.release(),
+            'qemu': qemu, 'libvirt': _version(libvirt.getVersion()),
+            'storage': utils.STORAGE_PROFILE}
+
+
+class ResultsDB(object):
+    def __init__(self, path=DEFAULT_PATH):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(SCHEMA)
+        columns = [row[1] for row in
+                   self._conn.execute('PRAGMA table_info(runs)')]
+        if 'storage' not in columns:
+            # Databases from before storage profiles only hold default runs
+            with self._conn:
+                self._conn.execute('ALTER TABLE runs ADD COLUMN storage TEXT')
+                self._conn.execute("UPDATE runs SET storage = 'default'")
+
+    def close(self):
+        self._conn.close()
+
+    def add_run(self, timings, statuses, info=None, started=None):
+        """
+        Store a run made of timing.TestTiming objects and the status of
+        each test by name, returning the id of the run.
+        """
+        info = info if info is not None else versions()
+        with self._conn:
+            cur = self._conn.execute(
+                'INSERT INTO runs (started, host, kernel, qemu, libvirt, '
+                'storage) VALUES (?, ?, ?, ?, ?, ?)',
+                (started or time.time(), info.get('host'),
+                 info.get('kernel'), info.get('qemu'), info.get('libvirt'),
+                 info.get('storage')))
+            run = cur.lastrowid
+            for t in timings:
+                jobBytes = t.metrics.get('job_bytes')
+                jobTime = t.phases.get(timing.JOB)
+                throughput = (float(jobBytes) / jobTime
+                              if jobBytes and jobTime else None)
+                self._conn.execute(
+                    'INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                    (run, t.name, statuses.get(t.name), t.total, jobBytes,
+                     throughput))
+                self._conn.executemany(
+                    'INSERT INTO phases VALUES (?, ?, ?, ?)',
+                    [(run, t.name, name, seconds)
+                     for name, seconds in t.phases.items()])
+        return run
+
+    def runs(self):
+        return self._conn.execute(
+            'SELECT id, started, host, kernel, qemu, libvirt, storage FROM '
+            'runs ORDER BY id').fetchall()
+
+    def storage(self, runs):
+        """
+        Return the set of storage profiles runs were made with.
+        """
+        marks = ','.join('?' * len(runs))
+        return set(row[0] for row in self._conn.execute(
+            'SELECT storage FROM runs WHERE id IN (%s)' % marks, runs))
+
+    def samples(self, runs, metric='total'):
+        """
+        Return {test: [value, ...]} of the passing tests of runs.
+        """
+        marks = ','.join('?' * len(runs))
+        if metric in ('total', 'throughput'):
+            query = ('SELECT test, %s FROM results WHERE run IN (%s) AND '
+                     "status = 'ok'" % (metric, marks))
+        else:
+            query = ('SELECT p.test, p.seconds FROM phases p JOIN results r '
+                     'ON p.run = r.run AND p.test = r.test WHERE p.run IN '
+                     "(%s) AND r.status = 'ok' AND p.phase = ?" % marks)
+            runs = list(runs) + [metric]
+        samples = {}
+        for test, value in self._conn.execute(query, runs):
+            if value is not None:
+                samples.setdefault(test, []).append(value)
+        return samples
+
+    def durations(self, storage=None):
+        """
+        Return {test: mean total} over every passing run of each test, only
+        counting runs made with the storage profile storage if given.
+        """
+        query = ("SELECT r.test, AVG(r.total) FROM results r JOIN runs ON "
+                 "r.run = runs.id WHERE r.status = 'ok'")
+        args = ()
+        if storage is not None:
+            query += ' AND runs.storage = ?'
+            args = (storage,)
+        return dict(self._conn.execute(query + ' GROUP BY r.test',
+                                       args).fetchall())
+
+
+def _betacf(a, b, x):
+    # Continued fraction of the incomplete beta function, by the modified
+    # Lentz method (Numerical Recipes 6.4)
+    tiny = 1e-300
+    qab, qap, qam = a + b, a + 1.0, a - 1.0
+    c = 1.0
+    d = 1.0 - qab * x / qap
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 300):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + aa / c
+        c = c if abs(c) > tiny else tiny
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + aa / c
+        c = c if abs(c) > tiny else tiny
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 3e-12:
+            break
+    return h
+
+
+def betainc(a, b, x):
+    """
+    Regularized incomplete beta function I_x(a, b).
+    """
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                     a * math.log(x) + b * math.log(1.0 - x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+
+def t_sf(t, df):
+    """
+    Probability that a Student t variable with df degrees of freedom
+    exceeds t.
+    """
+    p = 0.5 * betainc(df / 2.0, 0.5, df / (df + t * t))
+    return p if t > 0 else 1.0 - p
+
+
+def _mean_var(values):
+    n = len(values)
+    mean = sum(values) / float(n)
+    return mean, sum((v - mean) ** 2 for v in values) / (n - 1)
+
+
+def welch(baseline, candidate):
+    """
+    One sided Welch t-test that candidate is larger than baseline.  Returns
+    (t, degrees of freedom, p) or None with fewer than two samples each.
+    """
+    if len(baseline) < 2 or len(candidate) < 2:
+        return None
+    m1, v1 = _mean_var(baseline)
+    m2, v2 = _mean_var(candidate)
+    s1, s2 = v1 / len(baseline), v2 / len(candidate)
+    if s1 + s2 == 0:
+        return None
+    t = (m2 - m1) / math.sqrt(s1 + s2)
+    df = (s1 + s2) ** 2 / ((s1 ** 2 / (len(baseline) - 1) if s1 else 0) +
+                           (s2 ** 2 / (len(candidate) - 1) if s2 else 0))
+    return t, df, t_sf(t, df)
+
+
+def paired_log_ratio(pairs):
+    """
+    One sided t-test that the mean log ratio of (baseline, candidate) pairs
+    is above zero, i.e. that the candidate is slower across tests.  Returns
+    (geometric mean ratio, t, p) or None with fewer than two pairs.
+    """
+    ratios = [math.log(c / b) for b, c in pairs if b > 0 and c > 0]
+    if len(ratios) < 2:
+        return None
+    mean, var = _mean_var(ratios)
+    if var == 0:
+        return None
+    t = mean / math.sqrt(var / len(ratios))
+    return math.exp(mean), t, t_sf(t, len(ratios) - 1)
+
+
+def compare(db, baseline, candidate, metric='total', alpha=0.05):
+    """
+    Compare the runs in candidate against those in baseline.  Returns a
+    list of per test rows and the suite wide paired log-ratio test.  With
+    repeated runs each test is checked with Welch's t-test; single runs
+    are only judged suite wide.  Runs made with different storage profiles
+    are never compared.
+    """
+    profiles = db.storage(list(baseline) + list(candidate))
+    if len(profiles) > 1:
+        raise ValueError("Runs use different storage profiles: %s" %
+                         ', '.join(sorted(str(p) for p in profiles)))
+    sign = -1 if metric in HIGHER_IS_BETTER else 1
+    base = db.samples(baseline, metric)
+    cand = db.samples(candidate, metric)
+    rows = []
+    pairs = []
+    for test in sorted(set(base) & set(cand)):
+        b = [sign * v for v in base[test]]
+        c = [sign * v for v in cand[test]]
+        bMean = sum(base[test]) / len(base[test])
+        cMean = sum(cand[test]) / len(cand[test])
+        # Order each pair so that a ratio above one means slower
+        pairs.append((bMean, cMean) if sign > 0 else (cMean, bMean))
+        welchResult = welch(b, c)
+        p = welchResult[2] if welchResult is not None else None
+        rows.append({'test': test, 'baseline': bMean, 'candidate': cMean,
+                     'change': (cMean - bMean) / bMean if bMean else None,
+                     'p': p, 'slower': p is not None and p < alpha})
+    suite = paired_log_ratio(pairs)
+    return rows, suite
+
+
+def _runIds(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Live merge test results')
+    parser.add_argument('--db', default=DEFAULT_PATH)
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('list', help='list stored runs')
+    cmp_ = sub.add_parser('compare', help='find slowdowns between runs')
+    cmp_.add_argument('baseline', type=_runIds)
+    cmp_.add_argument('candidate', type=_runIds)
+    cmp_.add_argument('--metric', default='total')
+    cmp_.add_argument('--alpha', type=float, default=0.05)
+    args = parser.parse_args(argv)
+
+    db = ResultsDB(args.db)
+    try:
+        if args.command == 'list':
+            for row in db.runs():
+                (run, started, host, kernel, qemu, libvirtVersion,
+                 storage) = row
+                print '%4i  %s  %s  %s  %s  libvirt %s  %s' % (
+                    run, time.strftime('%Y-%m-%d %H:%M',
+                                       time.localtime(started)),
+                    host, kernel, qemu, libvirtVersion, storage)
+            return 0
+
+        try:
+            rows, suite = compare(db, args.baseline, args.candidate,
+                                  args.metric, args.alpha)
+        except ValueError, e:
+            sys.stderr.write('%s\n' % e)
+            return 2
+        slower = False
+        for row in rows:
+            flag = 'SLOWER' if row['slower'] else ''
+            change = ('%+7.1f%%' % (100 * row['change'])
+                      if row['change'] is not None else '      -')
+            p = '%.4f' % row['p'] if row['p'] is not None else '     -'
+            print '%12.3f %12.3f %s  p=%s  %-6s %s' % (
+                row['baseline'], row['candidate'], change, p, flag,
+                row['test'])
+            slower = slower or row['slower']
+        if suite is not None:
+            ratio, t, p = suite
+            suiteSlower = p < args.alpha
+            print 'suite: geometric mean ratio %.3f, t=%.2f, p=%.4f%s' % (
+                ratio, t, p, ' SLOWER' if suiteSlower else '')
+            slower = slower or suiteSlower
+        return 1 if slower else 0
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,182 @@
+import array
+import os
+import threading
+import time
+
+import qcow2
+
+DEFAULT_INTERVAL = 1.0
+DEFAULT_CAPACITY = 1 << 16
+
+
+class RingBuffer(object):
+    """
+    Fixed capacity series of (timestamp, value) samples stored in two
+    preallocated arrays.  Once full, the oldest samples are overwritten.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._capacity = capacity
+        self._times = array.array('d', [0.0]) * capacity
+        # Doubles hold byte counts exactly up to 8 PiB
+        self._values = array.array('d', [0.0]) * capacity
+        self._count = 0
+        self._next = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value):
+        self._times[self._next] = timestamp
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self._capacity
+        self._count = min(self._count + 1, self._capacity)
+
+    def samples(self):
+        """
+        Return the stored samples as (timestamp, value) tuples, oldest first.
+        """
+        start = (self._next - self._count) % self._capacity
+        indexes = [(start + i) % self._capacity for i in xrange(self._count)]
+        return [(self._times[i], int(self._values[i])) for i in indexes]
+
+    def last(self):
+        if not self._count:
+            return None
+        i = (self._next - 1) % self._capacity
+        return self._times[i], int(self._values[i])
+
+
+def image_end_offset(path):
+    return lambda: qcow2.read_image_info(path).endOffset
+
+
+class FileAllocation(object):
+    """
+    Space allocated to a file, read with fstat on a descriptor kept open
+    for the lifetime of the sampler.
+    """
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def __call__(self):
+        return os.fstat(self._fd).st_blocks * 512
+
+    def close(self):
+        os.close(self._fd)
+
+
+def domain_allocation(dom, disk):
+    # virDomainGetBlockInfo returns [capacity, allocation, physical]
+    return lambda: dom.blockInfo(disk, 0)[1]
+
+
+def block_job_field(dom, path, field):
+    # An empty dict once the job is gone, so the KeyError skips the sample
+    return lambda: dom.blockJobInfo(path, 0)[field]
+
+
+def block_stats_field(dom, disk, index):
+    # virDomainBlockStats returns (rd_req, rd_bytes, wr_req, wr_bytes, errs)
+    return lambda: dom.blockStats(disk)[index]
+
+
+class AllocationSampler(threading.Thread):
+    """
+    Sample any number of allocation sources from a single thread at a fixed
+    interval.  Each source is a callable returning the current value and
+    gets its own RingBuffer.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, capacity=DEFAULT_CAPACITY):
+        threading.Thread.__init__(self, name='allocation-sampler')
+        self.daemon = True
+        self.interval = interval
+        self._capacity = capacity
+        self._sources = []
+        self._series = {}
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+
+    def add(self, label, reader):
+        with self._lock:
+            self._series[label] = RingBuffer(self._capacity)
+            self._sources = self._sources + [(label, reader)]
+
+    def add_image(self, label, path):
+        """
+        Track the qcow2 image end offset, read straight from the image
+        metadata.
+        """
+        self.add(label, image_end_offset(path))
+
+    def add_file(self, label, path):
+        """
+        Track the space allocated to a file, as reported by fstat.
+        """
+        self.add(label, FileAllocation(path))
+
+    def add_domain(self, label, dom, disk):
+        """
+        Track the allocation libvirt reports for one of a domain's disks.
+        """
+        self.add(label, domain_allocation(dom, disk))
+
+    def add_block_job(self, label, dom, path):
+        """
+        Track the progress of the block job on path as two series,
+        label.cur and label.end.
+        """
+        self.add(label + '.cur', block_job_field(dom, path, 'cur'))
+        self.add(label + '.end', block_job_field(dom, path, 'end'))
+
+    def add_block_stats(self, label, dom, disk):
+        """
+        Track the bytes the guest read from and wrote to disk as two
+        cumulative series, label.rd_bytes and label.wr_bytes.
+        """
+        self.add(label + '.rd_bytes', block_stats_field(dom, disk, 1))
+        self.add(label + '.wr_bytes', block_stats_field(dom, disk, 3))
+
+    def series(self, label):
+        return self._series[label]
+
+    def samples(self):
+        """
+        Return a dict mapping each label to its list of samples.
+        """
+        with self._lock:
+            series = dict(self._series)
+        return dict((label, buf.samples()) for label, buf in series.items())
+
+    def sample_once(self):
+        for label, reader in self._sources:
+            try:
+                value = reader()
+            except Exception:
+                # The image may be in the middle of being rewritten or the
+                # domain going away; a missed sample must not kill the
+                # sampler.
+                continue
+            self._series[label].append(time.time(), value)
+
+    def run(self):
+        deadline = time.time()
+        while not self._stopEvent.is_set():
+            self.sample_once()
+            # Schedule against absolute deadlines so slow reads do not make
+            # the sampling interval drift.
+            deadline += self.interval
+            delay = deadline - time.time()
+            if delay < 0:
+                deadline = time.time()
+                delay = 0
+            self._stopEvent.wait(delay)
+
+    def stop(self):
+        self._stopEvent.set()
+        self.join()
+        for label, reader in self._sources:
+            close = getattr(reader, 'close', None)
+            if close is not None:
+                close()
@@ -1,12 +1,28 @@
 import sys
 import os
+import glob
+import heapq
+import json
+import time
 import unittest
+import multiprocessing
+import multiprocessing.util
 from functools import wraps
 from nose import config
 from nose import core
 from nose import result
+from nose import case
+from nose import loader
+
+import profiling
+import resultsdb
+import timing
+import tracing
+import utils
 
 PERMUTATION_ATTR = "_permutations_"
+# Number of tests listed in the end of run timing summary
+SLOWEST_COUNT = 10
 
 def _getPermutation(f, args):
     @wraps(f)
@@ -71,8 +87,15 @@ def colorWrite(stream, text, color):
 
 class VdsmTestResult(result.TextTestResult):
     def __init__(self, *args, **kwargs):
+        self.timingFile = kwargs.pop('timingFile', None)
+        self.resultsDb = kwargs.pop('resultsDb', None)
         result.TextTestResult.__init__(self, *args, **kwargs)
         self._last_case = None
+        self.timings = []
+        self.statuses = {}
+        self._remoteTiming = None
+        self._status = None
+        self._started = time.time()
 
     def getDescription(self, test):
         return str(test)
@@ -87,10 +110,12 @@ class VdsmTestResult(result.TextTestResult):
 
     def addSuccess(self, test):
         unittest.TestResult.addSuccess(self, test)
+        self._status = 'ok'
         self._writeResult(test, 'OK', TermColor.green, '.', True)
 
     def addFailure(self, test, err):
         unittest.TestResult.addFailure(self, test, err)
+        self._status = 'fail'
         self._writeResult(test, 'FAIL', TermColor.red, 'F', False)
 
     def addSkip(self, test, reason):
@@ -99,6 +124,7 @@ class VdsmTestResult(result.TextTestResult):
         if SkipTest in self.errorClasses:
             storage, label, isfail = self.errorClasses[SkipTest]
             storage.append((test, reason))
+            self._status = 'skip'
             self._writeResult(test, 'SKIP : %s' % reason, TermColor.blue, 'S',
                               True)
 
@@ -114,6 +140,7 @@ class VdsmTestResult(result.TextTestResult):
             if result.isclass(ec) and issubclass(ec, cls):
                 if isfail:
                     test.passed = False
+                self._status = 'error' if isfail else 'skip'
                 storage.append((test, exc_info))
                 # Might get patched into a streamless result
                 if stream is not None:
@@ -128,9 +155,31 @@ class VdsmTestResult(result.TextTestResult):
                 return
         self.errors.append((test, exc_info))
         test.passed = False
+        self._status = 'error'
         if stream is not None:
             self._writeResult(test, 'ERROR', TermColor.red, 'E', False)
 
+    def addOutcome(self, test, status, detail, timingData=None):
+        """
+        Record the outcome of a test that was run by a parallel worker.  The
+        failure details arrive already formatted.
+        """
+        if timingData is not None:
+            self._remoteTiming = timing.TestTiming.from_dict(timingData)
+        if status == 'ok':
+            self.addSuccess(test)
+        elif status == 'skip':
+            self.addSkip(test, detail)
+        elif status == 'fail':
+            self.failures.append((test, detail))
+            self._status = 'fail'
+            self._writeResult(test, 'FAIL', TermColor.red, 'F', False)
+        else:
+            self.errors.append((test, detail))
+            test.passed = False
+            self._status = 'error'
+            self._writeResult(test, 'ERROR', TermColor.red, 'E', False)
+
     def startTest(self, test):
         unittest.TestResult.startTest(self, test)
         current_case = test.test.__class__.__name__
@@ -143,27 +192,343 @@ class VdsmTestResult(result.TextTestResult):
             self.stream.write(
                 '    %s' % str(test.test._testMethodName).ljust(60))
             self.stream.flush()
+        timing.begin_test(test.id())
+
+    def stopTest(self, test):
+        t = timing.end_test()
+        if self._remoteTiming is not None:
+            t, self._remoteTiming = self._remoteTiming, None
+        if t is not None:
+            self.timings.append(t)
+            self.statuses[t.name] = self._status
+            if self.showAll and t.phases:
+                self.stream.writeln('        %s' % _formatPhases(t.phases))
+        self._status = None
+        unittest.TestResult.stopTest(self, test)
+
+    def printSummary(self, start, stop):
+        result.TextTestResult.printSummary(self, start, stop)
+        if not self.timings:
+            return
+        self.printTimingSummary()
+        if tracing.enabled():
+            self.printTracingSummary()
+        if self.timingFile:
+            self.writeTimingFile(self.timingFile)
+        if self.resultsDb:
+            self.writeResultsDb(self.resultsDb)
+
+    def _phaseTotals(self):
+        totals = {}
+        for t in self.timings:
+            for name, seconds in t.phases.items():
+                totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def printTimingSummary(self):
+        self.stream.writeln()
+        self.stream.writeln('Slowest tests:')
+        slowest = sorted(self.timings, key=lambda t: t.total, reverse=True)
+        for t in slowest[:SLOWEST_COUNT]:
+            self.stream.writeln('  %9.3fs  %s' % (t.total, t.name))
+        self.stream.writeln('Slowest phases:')
+        totals = self._phaseTotals()
+        for name in sorted(totals, key=totals.get, reverse=True):
+            self.stream.writeln('  %9.3fs  %s' % (totals[name], name))
+
+    def printTracingSummary(self):
+        suiteTime = sum(t.total for t in self.timings) or 1.0
+        self.stream.writeln()
+        self.stream.writeln('External commands by tool:')
+        self.stream.writeln('  %6s  %9s  %6s  %10s  %s' %
+                            ('count', 'wall', 'share', 'output', 'tool'))
+        tools = tracing.by_tool()
+        for name in sorted(tools, key=lambda n: tools[n][1], reverse=True):
+            count, wall, output = tools[name]
+            self.stream.writeln('  %6i  %8.3fs  %5.1f%%  %10i  %s' %
+                                (count, wall, 100 * wall / suiteTime,
+                                 output, name))
+        self.stream.writeln('External commands by test:')
+        tests = tracing.by_test()
+        slowest = sorted(tests, key=lambda n: tests[n][1], reverse=True)
+        for name in slowest[:SLOWEST_COUNT]:
+            count, wall, output = tests[name]
+            self.stream.writeln('  %6i  %8.3fs  %s' % (count, wall, name))
+
+    def writeTimingFile(self, path):
+        data = {'tests': [t.to_dict() for t in self.timings],
+                'phases': self._phaseTotals(),
+                'storage': utils.STORAGE_PROFILE}
+        if tracing.enabled():
+            data['commands'] = [r.to_dict() for r in tracing.records()]
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+    def writeResultsDb(self, path):
+        db = resultsdb.ResultsDB(path)
+        try:
+            run = db.add_run(self.timings, self.statuses,
+                             started=self._started)
+        finally:
+            db.close()
+        self.stream.writeln('Results stored as run %i in %s' % (run, path))
+
+
+def _formatPhases(phases):
+    return ', '.join('%s %.3fs' % (name, phases[name])
+                     for name in sorted(phases, key=phases.get,
+                                        reverse=True))
+
+
+class _CollectingResult(unittest.TestResult):
+    def __init__(self):
+        unittest.TestResult.__init__(self)
+        self.status = 'ok'
+        self.detail = None
+
+    def _record(self, status, detail):
+        # Keep the first problem, later ones usually come from teardown
+        if self.status in ('ok', 'skip'):
+            self.status = status
+            self.detail = detail
+
+    def addFailure(self, test, err):
+        self._record('fail', self._exc_info_to_string(err, test))
+
+    def addError(self, test, err):
+        self._record('error', self._exc_info_to_string(err, test))
+
+    def addSkip(self, test, reason):
+        self._record('skip', reason)
+
+
+def _initWorker(counter):
+    with counter.get_lock():
+        counter.value += 1
+        workerId = counter.value
+    utils.configure_worker(workerId)
+
+
+_workerModules = set()
+
+
+def _setUpWorkerModule(module):
+    """
+    Module fixtures run once per worker rather than once per test so that
+    session scoped state, like the image chain cache, survives between the
+    tests a worker runs.
+    """
+    if module.__name__ in _workerModules:
+        return
+    _workerModules.add(module.__name__)
+    setUp = getattr(module, 'setUpModule', None)
+    if setUp is not None:
+        setUp()
+    tearDown = getattr(module, 'tearDownModule', None)
+    if tearDown is not None:
+        multiprocessing.util.Finalize(None, tearDown, exitpriority=10)
+
+
+def _runWorkerTest(key):
+    moduleName, className, methodName = key
+    module = __import__(moduleName)
+    test = getattr(module, className)(methodName)
+    collector = _CollectingResult()
+    tracing.reset()
+    timing.begin_test(test.id())
+    try:
+        _setUpWorkerModule(module)
+    except Exception:
+        collector.addError(test, sys.exc_info())
+    else:
+        profiler = profiling.start(test.id())
+        try:
+            test.run(collector)
+        finally:
+            profiling.stop(profiler, test.id())
+    t = timing.end_test()
+    commands = [r.to_dict() for r in tracing.records()]
+    return key, collector.status, collector.detail, t.to_dict(), commands
+
+
+def _iterTests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in _iterTests(test):
+                yield t
+        else:
+            yield test
+
+
+def collectTests(names, testdir):
+    """
+    Expand the test names given on the command line, or every Test*.py
+    module in testdir, into a list of individual test cases.
+    """
+    if not names:
+        names = [os.path.basename(f)
+                 for f in sorted(glob.glob(os.path.join(testdir, 'Test*.py')))]
+    names = [n[:-3] if n.endswith('.py') else n for n in names]
+    names = [n.replace(':', '.') for n in names]
+    if testdir not in sys.path:
+        sys.path.insert(0, testdir)
+    suite = unittest.TestLoader().loadTestsFromNames(names)
+    return list(_iterTests(suite))
+
+
+def parseShard(value):
+    """
+    Parse a shard given as 'i/N', i counting from 1, into (i, N).
+    """
+    try:
+        index, count = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise ValueError("Invalid shard %r, expected i/N" % value)
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard %r, i must be in 1..N" % value)
+    return index, count
+
+
+def shardTests(tests, index, count, durations):
+    """
+    Return the tests of shard index out of count, keeping their order.
+
+    Tests are spread by their mean duration in seconds from durations,
+    longest first, each to the shard with the least work so far.  Tests
+    without history weigh as much as an average test.  Every node given the
+    same tests and durations computes the same split.
+    """
+    known = [durations[t.id()] for t in tests if t.id() in durations]
+    default = sum(known) / len(known) if known else 1.0
+    weights = dict((t.id(), durations.get(t.id(), default)) for t in tests)
+    shards = [(0.0, i) for i in range(count)]
+    assigned = {}
+    for testId in sorted(weights, key=lambda n: (-weights[n], n)):
+        load, shard = heapq.heappop(shards)
+        assigned[testId] = shard
+        heapq.heappush(shards, (load + weights[testId], shard))
+    return [t for t in tests if assigned[t.id()] == index - 1]
+
+
+def _durations(path):
+    if not os.path.exists(path):
+        return {}
+    db = resultsdb.ResultsDB(path)
+    try:
+        return db.durations(utils.STORAGE_PROFILE)
+    finally:
+        db.close()
+
+
+def _testKey(test):
+    return (test.__class__.__module__, test.__class__.__name__,
+            test._testMethodName)
+
 
 class VdsmTestRunner(core.TextTestRunner):
     def __init__(self, *args, **kwargs):
+        self.timingFile = kwargs.pop('timingFile', None)
+        self.resultsDb = kwargs.pop('resultsDb', None)
         core.TextTestRunner.__init__(self, *args, **kwargs)
 
     def _makeResult(self):
         return VdsmTestResult(self.stream,
                               self.descriptions,
                               self.verbosity,
-                              self.config)
+                              self.config,
+                              timingFile=self.timingFile,
+                              resultsDb=self.resultsDb)
 
     def run(self, test):
         result_ = core.TextTestRunner.run(self, test)
         return result_
 
+    def runParallel(self, tests, jobs):
+        """
+        Run tests in a pool of worker processes, each with its own image
+        directory, loop devices and domain names, and report the outcomes
+        through a single VdsmTestResult.
+        """
+        result_ = self._makeResult()
+        self.config.plugins.prepareTestResult(result_)
+        byKey = dict((_testKey(t), case.Test(t, config=self.config))
+                     for t in tests)
+        counter = multiprocessing.Value('i', 0)
+        start = time.time()
+        pool = multiprocessing.Pool(jobs, _initWorker, (counter,))
+        try:
+            outcomes = pool.imap_unordered(_runWorkerTest,
+                                           [_testKey(t) for t in tests])
+            for key, status, detail, timingData, commands in outcomes:
+                tracing.add([tracing.CommandRecord.from_dict(c)
+                             for c in commands])
+                test = byKey[key]
+                result_.startTest(test)
+                result_.addOutcome(test, status, detail, timingData)
+                result_.stopTest(test)
+        finally:
+            pool.close()
+            pool.join()
+        stop = time.time()
+        result_.printErrors()
+        result_.printSummary(start, stop)
+        self.config.plugins.finalize(result_)
+        return result_
+
+
+def _popOption(argv, shortName, longName):
+    """
+    Remove an option that nose does not know about from argv and return its
+    value.  Accepts '-j 4', '-j4', '--jobs 4' and '--jobs=4'.
+    """
+    value = None
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg in (shortName, longName) and i + 1 < len(argv):
+            value = argv[i + 1]
+            del argv[i:i + 2]
+            continue
+        elif arg.startswith(longName + '='):
+            value = arg[len(longName) + 1:]
+        elif shortName and arg.startswith(shortName) and arg != shortName:
+            value = arg[len(shortName):]
+        else:
+            i += 1
+            continue
+        del argv[i]
+    return value
+
+
+def _popFlag(argv, name):
+    if name in argv[1:]:
+        argv.remove(name)
+        return True
+    return False
+
 
 def run():
-    argv = sys.argv
+    argv = list(sys.argv)
     stream = sys.stdout
     verbosity = 3
     testdir = os.path.dirname(os.path.abspath(__file__))
+    jobs = int(_popOption(argv, '-j', '--jobs') or 1)
+    timingFile = _popOption(argv, None, '--timing-file')
+    resultsDb = (_popOption(argv, None, '--results-db') or
+                 os.environ.get('LIVEMERGE_RESULTS_DB'))
+    if _popFlag(argv, '--trace-subprocess'):
+        tracing.enable()
+    if _popFlag(argv, '--offline'):
+        # Inherited by parallel workers through the environment
+        os.environ['LIVEMERGE_OFFLINE'] = '1'
+    if _popFlag(argv, '--domain-pool'):
+        os.environ['LIVEMERGE_DOMAIN_POOL'] = '1'
+    shard = _popOption(argv, None, '--shard')
+    if shard is not None:
+        try:
+            shard = parseShard(shard)
+        except ValueError, e:
+            sys.exit(str(e))
 
     conf = config.Config(stream=stream,
                          env=os.environ,
@@ -173,9 +538,32 @@ def run():
 
     runner = VdsmTestRunner(stream=conf.stream,
                             verbosity=conf.verbosity,
-                            config=conf)
-
-    sys.exit(not core.run(config=conf, testRunner=runner, argv=argv))
+                            config=conf,
+                            timingFile=timingFile,
+                            resultsDb=resultsDb)
+
+    # Enabled with --profile-tests
+    profiler = profiling.TestProfiler()
+
+    if jobs > 1 or shard is not None:
+        conf.plugins.addPlugins(extraplugins=[profiler])
+        conf.configure(argv)
+        tests = collectTests(conf.testNames, testdir)
+        if shard is not None:
+            # Balanced by the durations of earlier runs, so every node
+            # should read the same results database
+            durations = _durations(resultsDb or resultsdb.DEFAULT_PATH)
+            total = len(tests)
+            tests = shardTests(tests, shard[0], shard[1], durations)
+            stream.write('Shard %i/%i: %i of %i tests\n' %
+                         (shard[0], shard[1], len(tests), total))
+        if jobs > 1:
+            sys.exit(not runner.runParallel(tests, jobs).wasSuccessful())
+        suite = loader.TestLoader(config=conf).suiteClass(tests)
+        sys.exit(not runner.run(suite).wasSuccessful())
+
+    sys.exit(not core.run(config=conf, testRunner=runner, argv=argv,
+                          addplugins=[profiler]))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,330 @@
+import os
+import Queue
+import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from xml.etree import ElementTree
+
+import libvirt
+
+import qcow2
+import utils
+
+VG_SIZE = os.environ.get('LIVEMERGE_THIN_VG_SIZE', '20G')
+# Size extendable volumes start at and grow by
+CHUNK_SIZE = os.environ.get('LIVEMERGE_THIN_CHUNK', '128M')
+
+# Only look at our own loop device and never touch the host's volumes
+LVM_CONFIG = ('devices { filter = [ "a|^%(pv)s$|", "r|.*|" ] '
+              'issue_discards = 1%(devices)s }%(extra)s')
+
+# LVM 2.03 removed lvmetad, and 2.03.12 added the devices file, which would
+# hide a loop device not listed in it
+NO_LVMETAD = (2, 3, 0)
+DEVICES_FILE = (2, 3, 12)
+
+_lvmVersion = None
+
+
+def lvm_version():
+    """
+    Return the version of the lvm tools as a tuple, e.g. (2, 3, 16).
+    """
+    global _lvmVersion
+    if _lvmVersion is None:
+        output = subprocess.check_output(['lvm', 'version'])
+        m = re.search(r'LVM version:\s*(\d+)\.(\d+)\.(\d+)', output)
+        if m is None:
+            raise RuntimeError("Cannot parse lvm version: %r" % output)
+        _lvmVersion = tuple(int(v) for v in m.groups())
+    return _lvmVersion
+
+
+def lvm_config(pv):
+    """
+    Build the --config of lvm commands on pv, using only the settings the
+    installed lvm knows.
+    """
+    version = lvm_version()
+    devices = ' use_devicesfile = 0' if version >= DEVICES_FILE else ''
+    extra = (' global { use_lvmetad = 0 }' if version < NO_LVMETAD
+             else '')
+    return LVM_CONFIG % {'pv': pv, 'devices': devices, 'extra': extra}
+
+
+class LvmVolumePool(object):
+    """
+    Logical volumes in a volume group on a sparse loop device, leased out
+    like LoopDevicePool devices.
+
+    Extendable volumes start at one chunk and are grown with extend(), the
+    way qcow2 volumes on block storage are grown in production when the
+    guest writes past a high watermark.  Released volumes are discarded,
+    which punches holes in the backing file, so new volumes read as zeros.
+    """
+
+    def __init__(self, directory, vgName, size=VG_SIZE, chunk=CHUNK_SIZE):
+        self._dir = directory
+        self._vg = vgName
+        self._size = utils.parse_size(size)
+        self.chunk = utils.parse_size(chunk)
+        self._pv = None
+        self._count = 0
+        self._discards = True
+        self._lock = threading.Lock()
+
+    def _lvm(self, *args):
+        cmd = ['lvm', args[0], '--config', lvm_config(self._pv)]
+        cmd.extend(args[1:])
+        return subprocess.check_output(cmd)
+
+    def _setup(self):
+        if self._pv is not None:
+            return
+        utils._makedirs(self._dir)
+        fname = os.path.join(self._dir, 'pv.img')
+        with open(fname, 'w') as f:
+            f.truncate(self._size)
+        self._pv = utils.attach_loop_dev(fname)
+        self._lvm('pvcreate', '-ff', '-y', self._pv)
+        self._lvm('vgcreate', self._vg, self._pv)
+
+    def lease(self, size=utils.IMAGESIZE, extendable=False):
+        size = utils.parse_size(size)
+        if extendable:
+            size = min(size, self.chunk)
+        with self._lock:
+            self._setup()
+            name = 'lv-%i' % self._count
+            self._count += 1
+            self._lvm('lvcreate', '-y', '-Wn', '-Zn', '-n', name,
+                      '-L', '%ib' % size, self._vg)
+        return '/dev/%s/%s' % (self._vg, name)
+
+    def zeroed(self, dev):
+        return self._discards
+
+    def release(self, dev):
+        if not utils.reset_block_dev(dev, self.size(dev)):
+            self._discards = False
+        self._lvm('lvremove', '-f', dev)
+
+    def size(self, dev):
+        fd = os.open(dev, os.O_RDONLY)
+        try:
+            return os.lseek(fd, 0, os.SEEK_END)
+        finally:
+            os.close(fd)
+
+    def extend(self, dev, size=None):
+        """
+        Grow dev by size bytes, one chunk by default, and return its new
+        size.
+        """
+        self._lvm('lvextend', '-L', '+%ib' % (size or self.chunk), dev)
+        return self.size(dev)
+
+    def destroy(self):
+        with self._lock:
+            if self._pv is not None:
+                self._lvm('vgremove', '-f', self._vg)
+                self._lvm('pvremove', '-y', self._pv)
+                utils.detach_loop_devs([self._pv])
+                self._pv = None
+            if os.path.exists(self._dir):
+                shutil.rmtree(self._dir)
+
+
+_volumePool = None
+
+
+def get_volume_pool():
+    global _volumePool
+    if _volumePool is None:
+        _volumePool = LvmVolumePool(utils.IMAGEDIR + '.lvm',
+                                    utils.domain_name('livemerge-vg'))
+    return _volumePool
+
+
+def destroy_volume_pool():
+    global _volumePool
+    if _volumePool is not None:
+        _volumePool.destroy()
+        _volumePool = None
+
+
+def import_image(name, src, headroom=None):
+    """
+    Copy the qcow2 image src onto a new extendable volume registered as
+    block image name, leaving headroom bytes, one chunk by default, free
+    beyond the data copied.
+    """
+    pool = get_volume_pool()
+    info = qcow2.read_image_info(src)
+    dev = pool.lease(info.endOffset + (headroom or pool.chunk))
+    cmd = ['qemu-img', 'convert', '-f', 'qcow2', '-O', 'qcow2', src, dev]
+    subprocess.check_call(cmd)
+    utils._blockdevs[name] = dev
+    return dev
+
+
+def chain_target(dom, target, path):
+    """
+    Name the image path of the chain of disk target the way libvirt
+    expects it for block thresholds: 'vda' for the active layer and
+    'vda[N]' for backing images.
+    """
+    root = ElementTree.fromstring(dom.XMLDesc(0))
+    for disk in root.findall('devices/disk'):
+        if disk.find('target').get('dev') != target:
+            continue
+        node = disk
+        while node is not None:
+            source = node.find('source')
+            if source is not None and path in (source.get('file'),
+                                               source.get('dev')):
+                index = node.get('index')
+                if node is disk or index is None:
+                    return target
+                return '%s[%s]' % (target, index)
+            node = node.find('backingStore')
+    raise ValueError("%s is not in the chain of %s" % (path, target))
+
+
+class Extension(namedtuple('Extension', 'dev path threshold start end '
+                                        'oldSize newSize')):
+    @property
+    def latency(self):
+        return self.end - self.start
+
+    @property
+    def extended(self):
+        return self.newSize - self.oldSize
+
+
+# A guest pause on ENOSPC, end is None if the guest was never resumed
+Pause = namedtuple('Pause', 'dev path start end')
+
+
+class WatermarkMonitor(object):
+    """
+    Extend the volumes of a domain as the guest or a block job writes into
+    them.
+
+    Each watched volume gets a block threshold one watermark below its end.
+    When VIR_DOMAIN_EVENT_ID_BLOCK_THRESHOLD reports it crossed, the volume
+    is extended by a chunk and the threshold set again.  A guest paused
+    because a volume ran out of space is extended and resumed.  Events are
+    handled in a thread of the monitor so that lvextend never blocks the
+    libvirt event loop.
+    """
+
+    def __init__(self, dom, pool, watermark=None):
+        self._dom = dom
+        self._pool = pool
+        self._watermark = watermark or pool.chunk / 2
+        self._volumes = {}
+        self._callbacks = []
+        self._queue = Queue.Queue()
+        self._thread = None
+        self.extensions = []
+        self.pauses = []
+        self.errors = []
+
+    def watch(self, dev, path):
+        """
+        Monitor volume path, known to libvirt as dev ('vda' or 'vda[1]').
+        """
+        self._volumes[dev] = path
+        self._arm(dev)
+
+    def _arm(self, dev):
+        size = self._pool.size(self._volumes[dev])
+        self._dom.setBlockThreshold(dev, max(0, size - self._watermark), 0)
+
+    def _dev(self, path):
+        for dev, p in self._volumes.items():
+            if p == path:
+                return dev
+        return None
+
+    def start(self):
+        conn = self._dom.connect()
+        self._callbacks = [
+            conn.domainEventRegisterAny(
+                self._dom, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_THRESHOLD,
+                self._on_threshold, None),
+            conn.domainEventRegisterAny(
+                self._dom, libvirt.VIR_DOMAIN_EVENT_ID_IO_ERROR_REASON,
+                self._on_io_error, None),
+        ]
+        self._thread = threading.Thread(target=self._run,
+                                        name='watermark-monitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        conn = self._dom.connect()
+        for callbackId in self._callbacks:
+            try:
+                conn.domainEventDeregisterAny(callbackId)
+            except libvirt.libvirtError:
+                pass
+        self._callbacks = []
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _on_threshold(self, conn, dom, dev, path, threshold, excess, opaque):
+        self._queue.put(('threshold', dev, time.time(), threshold))
+
+    def _on_io_error(self, conn, dom, srcPath, devAlias, action, reason,
+                     opaque):
+        dev = self._dev(srcPath)
+        if reason == 'enospc' and dev is not None:
+            self._queue.put(('enospc', dev, time.time(), None))
+
+    def _extend(self, dev, start, threshold):
+        path = self._volumes[dev]
+        oldSize = self._pool.size(path)
+        newSize = self._pool.extend(path)
+        self.extensions.append(Extension(dev, path, threshold, start,
+                                         time.time(), oldSize, newSize))
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                return
+            kind, dev, start, threshold = event
+            try:
+                self._extend(dev, start, threshold)
+                if kind == 'enospc':
+                    pause = Pause(dev, self._volumes[dev], start, None)
+                    self._dom.resume()
+                    pause = pause._replace(end=time.time())
+                    self.pauses.append(pause)
+                self._arm(dev)
+            except (libvirt.libvirtError, subprocess.CalledProcessError), e:
+                if kind == 'enospc':
+                    self.pauses.append(Pause(dev, self._volumes[dev], start,
+                                             None))
+                self.errors.append(e)
+
+    def summary(self):
+        latencies = [e.latency for e in self.extensions]
+        paused = [p.end - p.start for p in self.pauses if p.end is not None]
+        return {
+            'extensions': len(self.extensions),
+            'extended_bytes': sum(e.extended for e in self.extensions),
+            'extension_latency_mean': (sum(latencies) / len(latencies)
+                                       if latencies else None),
+            'extension_latency_max': max(latencies) if latencies else None,
+            'enospc_pauses': len(self.pauses),
+            'paused_time': sum(paused),
+            'errors': len(self.errors),
+        }
@@ -0,0 +1,153 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+SETUP = 'setup'
+IMAGE_CREATION = 'image creation'
+VM_START = 'vm start'
+JOB = 'job'
+VERIFY = 'verify'
+TEARDOWN = 'teardown'
+
+# Wall time of a test not covered by any phase
+OTHER = 'other'
+
+_current = None
+_local = threading.local()
+
+
+class TestTiming(object):
+    """
+    Wall clock time of one test, split into phases.
+
+    Phases nest: time spent in an inner phase is charged to it alone, so the
+    phase times of a test never add up to more than its total.  Each thread
+    keeps its own stack of open phases.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.total = None
+        self.phases = {}
+        # Quantities measured by the test, like the bytes its jobs copied
+        self.metrics = {}
+        self._stacks = {}
+        self._lock = threading.Lock()
+
+    def _charge(self, stack, now):
+        entry = stack[-1]
+        self.phases[entry[0]] = self.phases.get(entry[0], 0.0) + now - entry[1]
+        entry[1] = now
+
+    def enter(self, phase):
+        now = time.time()
+        with self._lock:
+            stack = self._stacks.setdefault(threading.current_thread().ident,
+                                            [])
+            if stack:
+                self._charge(stack, now)
+            stack.append([phase, now])
+
+    def exit(self):
+        now = time.time()
+        with self._lock:
+            stack = self._stacks[threading.current_thread().ident]
+            self._charge(stack, now)
+            stack.pop()
+            if stack:
+                stack[-1][1] = now
+
+    def finish(self):
+        self.total = time.time() - self.start
+        other = self.total - sum(self.phases.values())
+        if other > 0:
+            self.phases[OTHER] = other
+
+    def add_metric(self, name, value):
+        with self._lock:
+            self.metrics[name] = self.metrics.get(name, 0) + value
+
+    def to_dict(self):
+        return {'name': self.name, 'total': self.total,
+                'phases': dict(self.phases), 'metrics': dict(self.metrics)}
+
+    @classmethod
+    def from_dict(cls, data):
+        t = cls(data['name'])
+        t.total = data['total']
+        t.phases = dict(data['phases'])
+        t.metrics = dict(data.get('metrics', {}))
+        return t
+
+
+def begin_test(name):
+    global _current
+    _current = TestTiming(name)
+    return _current
+
+
+def end_test():
+    global _current
+    t, _current = _current, None
+    if t is not None:
+        t.finish()
+    return t
+
+
+def current():
+    return _current
+
+
+def add_metric(name, value):
+    """
+    Add value to metric name of the running test, if any.
+    """
+    t = _current
+    if t is not None:
+        t.add_metric(name, value)
+
+
+@contextmanager
+def phase(name):
+    """
+    Charge the time spent in the with block to phase name of the running
+    test.  Does nothing when no test is being timed.
+    """
+    t = _current
+    if t is None or getattr(_local, 'untimed', False):
+        yield
+        return
+    t.enter(name)
+    try:
+        yield
+    finally:
+        t.exit()
+
+
+@contextmanager
+def untimed():
+    """
+    Stop charging phases from the calling thread.  For helper threads whose
+    work is already covered by a phase of the thread waiting for them;
+    charging both would count the same wall time twice.
+    """
+    _local.untimed = True
+    try:
+        yield
+    finally:
+        _local.untimed = False
+
+
+def timed(name):
+    """
+    Decorator charging the time spent in a function to phase name.
+    """
+    def wrap(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return wrap
@@ -0,0 +1,140 @@
+import os
+import subprocess
+import threading
+import time
+
+import timing
+
+_Popen = subprocess.Popen
+
+# Tools whose first argument selects what they do
+SUBCOMMAND_TOOLS = ('qemu-img', 'virsh', 'lvm', 'dmsetup')
+_records = []
+_lock = threading.Lock()
+
+
+class CommandRecord(object):
+    def __init__(self, argv, test, start, wall=None, returncode=None,
+                 outputSize=0):
+        self.argv = list(argv)
+        self.test = test
+        self.start = start
+        self.wall = wall
+        self.returncode = returncode
+        self.outputSize = outputSize
+
+    @property
+    def tool(self):
+        return tool_name(self.argv)
+
+    def to_dict(self):
+        return {'argv': self.argv, 'test': self.test, 'start': self.start,
+                'wall': self.wall, 'returncode': self.returncode,
+                'outputSize': self.outputSize}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['argv'], data['test'], data['start'], data['wall'],
+                   data['returncode'], data['outputSize'])
+
+
+def tool_name(argv):
+    """
+    Name a command by its executable and, for tools like qemu-img, its
+    subcommand: 'qemu-img info', 'losetup', 'qemu-io'.
+    """
+    if isinstance(argv, basestring):
+        argv = argv.split()
+    name = os.path.basename(argv[0])
+    if name in SUBCOMMAND_TOOLS and len(argv) > 1:
+        name = '%s %s' % (name, argv[1])
+    return name
+
+
+class TracedPopen(_Popen):
+    """
+    Popen recording the wall time, exit code and output size of every
+    external command.  The record is completed by whichever of wait() or
+    communicate() finishes the process.
+    """
+
+    def __init__(self, args, *a, **kw):
+        t = timing.current()
+        self._traceRecord = CommandRecord(
+            args if not isinstance(args, basestring) else [args],
+            t.name if t is not None else None, time.time())
+        _Popen.__init__(self, args, *a, **kw)
+        with _lock:
+            _records.append(self._traceRecord)
+
+    def _traceFinish(self):
+        record = self._traceRecord
+        if record.wall is None and self.returncode is not None:
+            record.wall = time.time() - record.start
+            record.returncode = self.returncode
+
+    def wait(self):
+        returncode = _Popen.wait(self)
+        self._traceFinish()
+        return returncode
+
+    def poll(self):
+        returncode = _Popen.poll(self)
+        self._traceFinish()
+        return returncode
+
+    def communicate(self, input=None):
+        out, err = _Popen.communicate(self, input)
+        self._traceFinish()
+        self._traceRecord.outputSize = len(out or '') + len(err or '')
+        return out, err
+
+
+def enable():
+    subprocess.Popen = TracedPopen
+
+
+def disable():
+    subprocess.Popen = _Popen
+
+
+def enabled():
+    return subprocess.Popen is TracedPopen
+
+
+def records():
+    with _lock:
+        return list(_records)
+
+
+def add(newRecords):
+    with _lock:
+        _records.extend(newRecords)
+
+
+def reset():
+    with _lock:
+        del _records[:]
+
+
+def _aggregate(key):
+    totals = {}
+    for r in records():
+        count, wall, output = totals.get(key(r), (0, 0.0, 0))
+        totals[key(r)] = (count + 1, wall + (r.wall or 0.0),
+                          output + r.outputSize)
+    return totals
+
+
+def by_tool():
+    """
+    Return {tool: (count, wall seconds, output bytes)}.
+    """
+    return _aggregate(lambda r: r.tool)
+
+
+def by_test():
+    """
+    Return {test name: (count, wall seconds, output bytes)}.
+    """
+    return _aggregate(lambda r: r.test)
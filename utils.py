@@ -1,16 +1,64 @@
+import atexit
+import errno
+import fcntl
 import os
+import struct
 import subprocess
 import shutil
 import re
 import libvirt
 import time
-import tempfile
-
-IMAGEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                        'tmp')
-IMAGESIZE = '10M'
+import threading
+from contextlib import contextmanager
+from xml.etree import ElementTree
+
+import fakedomain
+import imagecache
+import qcow2
+import timing
+
+# Storage profiles, selected with LIVEMERGE_STORAGE_PROFILE, as the
+# directory images are created in and extra attributes of the disk driver
+# element:
+#   default: tmp/ beside the source with the default qemu cache mode
+#   tmpfs:   a directory in /dev/shm, so fixture I/O never waits on a disk
+#   disk:    tmp/ beside the source, opened with O_DIRECT and native AIO so
+#            measurements reach the disk rather than the host page cache
+# LIVEMERGE_IMAGEDIR overrides the directory of any profile, for example to
+# measure a particular disk.
+_SOURCEDIR = os.path.dirname(os.path.abspath(__file__))
+STORAGE_PROFILES = {
+    'default': (os.path.join(_SOURCEDIR, 'tmp'), ''),
+    'tmpfs': ('/dev/shm/livemerge-tests', ''),
+    'disk': (os.path.join(_SOURCEDIR, 'tmp'), "cache='none' io='native'"),
+}
+STORAGE_PROFILE = os.environ.get('LIVEMERGE_STORAGE_PROFILE', 'default')
+if STORAGE_PROFILE not in STORAGE_PROFILES:
+    raise ValueError("Invalid storage profile: %s" % STORAGE_PROFILE)
+_BASE_IMAGEDIR = os.environ.get('LIVEMERGE_IMAGEDIR',
+                                STORAGE_PROFILES[STORAGE_PROFILE][0])
+DISK_DRIVER_ATTRS = STORAGE_PROFILES[STORAGE_PROFILE][1]
+IMAGEDIR = _BASE_IMAGEDIR
+
+
+def storage_info():
+    """
+    Describe where images of this process live, for exported results.
+    """
+    return {'storage': STORAGE_PROFILE, 'imagedir': IMAGEDIR}
+IMAGESIZE = os.environ.get('LIVEMERGE_IMAGESIZE', '10M')
 
 _blockdevs = {}
+_workerId = None
+_loopPool = None
+_loopPoolLock = threading.Lock()
+
+_SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30,
+               'T': 1 << 40}
+
+# From <linux/fs.h>: _IO(0x12, 119)
+BLKDISCARD = 0x1277
+RESET_HEADER_SIZE = 1 << 20
 
 
 def patch_subprocess():
@@ -18,172 +66,568 @@ def patch_subprocess():
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
         output = p.communicate()[0]
         if p.returncode != 0:
-            raise subprocess.CalledProcessError(r.returncode, cmd, output)
+            raise subprocess.CalledProcessError(p.returncode, cmd, output)
         return output
     if not hasattr(subprocess, 'check_output'):
         subprocess.check_output = check_output
 
 
-def get_image_path(imagename, relative, block):
+def get_image_path(imagename, relative, block, imagedir=None):
     if block:
         return _blockdevs[imagename]
     elif relative:
         return "%s.img" % imagename
     else:
-        return os.path.join(IMAGEDIR, "%s.img" % imagename)
+        return os.path.join(imagedir or IMAGEDIR, "%s.img" % imagename)
 
 
-def create_block_dev(name):
-    global _blockdevs
-    cmd = ['losetup', '-f']
-    output = subprocess.check_output(cmd)
+def configure_worker(workerId):
+    """
+    Isolate a parallel test worker from its siblings by giving it a private
+    image directory and domain names.
+    """
+    global IMAGEDIR, _workerId
+    _workerId = workerId
+    IMAGEDIR = os.path.join(_BASE_IMAGEDIR, 'worker-%i' % workerId)
+
+
+def offline():
+    """
+    In offline mode VMs are replaced by fakedomain.FakeDomain, which runs
+    block jobs with qemu-img and needs neither libvirtd nor KVM.
+    """
+    return bool(os.environ.get('LIVEMERGE_OFFLINE'))
+
+
+def domain_name(name):
+    if _workerId is None:
+        return name
+    return '%s-%i' % (name, _workerId)
+
+
+def attach_loop_dev(fname):
+    # Find and attach a free device in one step so that concurrent workers
+    # cannot race for the same device.
+    cmd = ['losetup', '-f', '--show', fname]
+    try:
+        output = subprocess.check_output(cmd)
+    except subprocess.CalledProcessError:
+        raise Exception("Unable to attach a loop device.  If the device "
+                        "nodes are missing please run "
+                        "'mknod -m 0660 /dev/loopN b 7 N' and retry.")
     if not output.startswith('/dev/loop'):
         raise ValueError("Unexpected output from losetup: %s" % output)
 
-    dev = output[:-1]  # Strip trailing newline
-    if not os.path.exists(dev):
-        raise Exception("Missing loop device.  To fix this please "
-                        "run 'mknod -m 0660 %s b 7 %s' and retry." %
-                        (dev, dev[9:]))
-    fname = "%s/%s.img" % (IMAGEDIR, name)
-    dd = ['dd', 'if=/dev/zero', 'of=%s' % fname, 'bs=%s' % IMAGESIZE, 'count=1']
-    losetup = ['losetup', dev, fname]
-    outf = open('/dev/null', 'w')
-    try:
-        subprocess.check_call(dd, stdout=outf, stderr=outf)
-        subprocess.check_call(losetup, stdout=outf, stderr=outf)
-    finally:
-        outf.close()
-    _blockdevs[name] = dev
+    return output[:-1]  # Strip trailing newline
 
 
-def create_image(name, backing=None, fmt='qcow2', backingFmt='qcow2',
-                 relative=False, block=False, size=IMAGESIZE):
-    if not os.path.exists(IMAGEDIR):
-        os.mkdir(IMAGEDIR, 0755)
+def detach_loop_devs(devs):
+    if devs:
+        cmd = ['losetup', '-d']
+        cmd.extend(devs)
+        subprocess.check_call(cmd)
 
-    cwd = os.getcwd()
-    os.chdir(IMAGEDIR)
-    outf = open('/dev/null', 'w')
 
+def parse_size(size):
+    """
+    Convert a qemu-img style size such as '10M' or '1G' into bytes.
+    """
+    m = re.match(r'^(\d+)([KMGT]?)B?$', str(size).strip().upper())
+    if not m:
+        raise ValueError("Invalid size: %s" % size)
+    return int(m.group(1)) * _SIZE_UNITS[m.group(2)]
+
+
+def _makedirs(path):
+    # Concurrent image builders may race to create the same directory
     try:
-        if block:
-            create_block_dev(name)
-        imagefile = get_image_path(name, relative, block)
-        cmd = ['qemu-img', 'create', '-f', fmt]
-        if backing:
-            backingfile = get_image_path(backing, relative, block)
-            #if not os.path.exists(backingfile):
-            #    raise ValueError("Backing file %s does not exist" %
-            #                     backingfile)
-            cmd.extend(['-b', backingfile, '-F', backingFmt, imagefile])
-        else:
-            cmd.extend([imagefile, size])
-        subprocess.check_call(cmd, stdout=outf, stderr=outf)
-        #subprocess.check_call(cmd)
-        os.chmod(imagefile, 0666)
+        os.makedirs(path, 0755)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def reset_block_dev(dev, size):
+    """
+    Discard the contents of dev and return True, or wipe its start and
+    return False when the device does not support discard.
+    """
+    fd = os.open(dev, os.O_WRONLY)
+    try:
+        try:
+            fcntl.ioctl(fd, BLKDISCARD, struct.pack('QQ', 0, size))
+            return True
+        except IOError:
+            # Without discard support, wiping the start of the device
+            # is enough for qemu-img to no longer see the old image.
+            os.write(fd, '\0' * min(size, RESET_HEADER_SIZE))
+            os.fsync(fd)
+            return False
     finally:
-        os.chdir(cwd)
-        outf.close()
+        os.close(fd)
+
+
+class LoopDevicePool(object):
+    """
+    Loop devices attached once per session to sparse backing files and
+    leased out to tests.  Released devices are discarded instead of being
+    detached so that the next lease starts from zeros.
+    """
+
+    def __init__(self, directory):
+        self._dir = directory
+        self._free = {}
+        self._devs = {}
+        self._zeroed = set()
+        self._lock = threading.Lock()
+
+    def lease(self, size=IMAGESIZE, extendable=False):
+        # Loop devices cannot grow, extendable images get their full size
+        size = parse_size(size)
+        with self._lock:
+            free = self._free.get(size)
+            if free:
+                return free.pop()
+            _makedirs(self._dir)
+            fname = os.path.join(self._dir, 'loop-%i.img' % len(self._devs))
+            with open(fname, 'w') as f:
+                f.truncate(size)
+            dev = attach_loop_dev(fname)
+            self._devs[dev] = size
+            self._zeroed.add(dev)
+            return dev
+
+    def zeroed(self, dev):
+        """
+        Whether dev read back as zeros when it was leased, in which case
+        copies onto it may skip zero blocks.
+        """
+        return dev in self._zeroed
+
+    def release(self, dev):
+        size = self._devs[dev]
+        zeroed = self._reset(dev, size)
+        with self._lock:
+            if zeroed:
+                self._zeroed.add(dev)
+            else:
+                self._zeroed.discard(dev)
+            self._free.setdefault(size, []).append(dev)
+
+    def _reset(self, dev, size):
+        return reset_block_dev(dev, size)
+
+    def destroy(self):
+        with self._lock:
+            detach_loop_devs(self._devs.keys())
+            self._devs = {}
+            self._free = {}
+            self._zeroed = set()
+            if os.path.exists(self._dir):
+                shutil.rmtree(self._dir)
+
+
+def get_loop_pool():
+    global _loopPool
+    with _loopPoolLock:
+        if _loopPool is None:
+            _loopPool = LoopDevicePool(IMAGEDIR + '.loop')
+        return _loopPool
+
+
+def destroy_loop_pool():
+    global _loopPool
+    if _loopPool is not None:
+        _loopPool.destroy()
+        _loopPool = None
+
+
+def block_backend():
+    """
+    Where block devices come from: 'loop' for fixed size loop devices or
+    'thin' for logical volumes extended on demand, see thinlvm.
+    """
+    return os.environ.get('LIVEMERGE_BLOCK_BACKEND', 'loop')
+
+
+def get_block_pool():
+    """
+    Return the pool block devices are leased from, a LoopDevicePool or a
+    thinlvm.LvmVolumePool.
+    """
+    if block_backend() == 'thin':
+        # thinlvm builds on this module, import it only when used
+        import thinlvm
+        return thinlvm.get_volume_pool()
+    return get_loop_pool()
+
+
+def destroy_block_pool():
+    destroy_loop_pool()
+    if block_backend() == 'thin':
+        import thinlvm
+        thinlvm.destroy_volume_pool()
+
+
+# Registered before the domain pool and the connection, so that atexit
+# shuts their domains down before the devices they use go away
+atexit.register(destroy_block_pool)
+
+
+def create_block_dev(name, size=IMAGESIZE, extendable=False):
+    global _blockdevs
+    _blockdevs[name] = get_block_pool().lease(size, extendable)
+
+
+@timing.timed(timing.IMAGE_CREATION)
+def create_image(name, backing=None, fmt='qcow2', backingFmt='qcow2',
+                 relative=False, block=False, size=IMAGESIZE, imagedir=None):
+    """
+    Create image name in imagedir.  qemu-img runs from imagedir so relative
+    image and backing names resolve there without touching the working
+    directory of the process, which keeps concurrent calls safe.
+    """
+    imagedir = imagedir or IMAGEDIR
+    _makedirs(imagedir)
+
+    if block:
+        # A raw image fills its device while a qcow2 image only needs room
+        # for the clusters it allocates
+        create_block_dev(name, size, extendable=fmt != 'raw')
+    imagefile = get_image_path(name, relative, block, imagedir)
+    cmd = ['qemu-img', 'create', '-f', fmt]
+    if backing:
+        backingfile = get_image_path(backing, relative, block, imagedir)
+        cmd.extend(['-b', backingfile, '-F', backingFmt, imagefile])
+    else:
+        cmd.extend([imagefile, size])
+    with open('/dev/null', 'w') as outf:
+        subprocess.check_call(cmd, stdout=outf, stderr=outf, cwd=imagedir)
 
     # Always return the absolute path to the image so it can be
     # passed along to libvirt and other functions which don't deal with
     # relative paths
-    return get_image_path(name, False, block)
+    imagefile = get_image_path(name, False, block, imagedir)
+    os.chmod(imagefile, 0666)
+    return imagefile
 
 
+@timing.timed(timing.TEARDOWN)
 def cleanup_images():
     global _blockdevs
-    loopdevs = _blockdevs.values()
     #subprocess.check_call(['losetup', '-l'])
-    if loopdevs:
-        cmd = ['losetup', '-d']
-        cmd.extend(loopdevs)
-        subprocess.check_call(cmd)
+    for dev in _blockdevs.values():
+        get_block_pool().release(dev)
     _blockdevs = {}
     if os.path.exists(IMAGEDIR):
         shutil.rmtree(IMAGEDIR)
 
 
-def write_image(imagefile, offset, length, pattern):
+_QEMU_IO_REPORT = re.compile(r'^(read|wrote) \d+/\d+ bytes at offset')
+
+
+def _run_qemu_io(imagefile, commands):
+    """
+    Run all commands in a single qemu-io process and return a list with the
+    outcome of each one.  A command succeeds when qemu-io prints its
+    transfer report and no pattern mismatch was reported for it.  If
+    qemu-io fails or its output cannot be matched to the commands, every
+    command has failed.
+    """
     assert os.path.exists(imagefile)
-    outf = open('/dev/null', 'w')
+    cmd = ['qemu-io']
+    for c in commands:
+        cmd.extend(['-c', c])
+    cmd.append(imagefile)
+
+    # Errors go to stderr, keep them in line with the transfer reports
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    output = p.communicate()[0]
+
+    results = []
+    mismatch = False
+    for line in output.splitlines():
+        if line.startswith('Pattern verification failed'):
+            mismatch = True
+        elif line.startswith('read failed') or line.startswith('write failed'):
+            results.append(False)
+            mismatch = False
+        elif _QEMU_IO_REPORT.match(line):
+            results.append(not mismatch)
+            mismatch = False
+
+    if p.returncode != 0 or len(results) != len(commands):
+        return [False] * len(commands)
+    return results
+
+
+@timing.timed(timing.IMAGE_CREATION)
+def write_extents(imagefile, extents):
+    """
+    Write a batch of (offset, length, pattern) extents using one qemu-io
+    process.  Returns a list of booleans, one per extent.
+    """
+    commands = ["write -P %i %i %i" % (pattern, offset, length)
+                for offset, length, pattern in extents]
+    return _run_qemu_io(imagefile, commands)
+
+
+@timing.timed(timing.VERIFY)
+def verify_extents(imagefile, extents):
+    """
+    Verify a batch of (offset, length, pattern) extents using one qemu-io
+    process.  Returns a list of booleans, one per extent.
+    """
+    commands = ["read -P %i -s 0 -l %i %i %i" % (pattern, length, offset,
+                                                 length)
+                for offset, length, pattern in extents]
+    return _run_qemu_io(imagefile, commands)
 
-    write_cmd = "write -P %i %i %i" % (pattern, offset, length)
-    cmd = ['qemu-io', '-c', write_cmd, imagefile]
-    try:
-        subprocess.check_call(cmd, stdout=outf, stderr=outf)
-    finally:
-        outf.close()
 
+def write_image(imagefile, offset, length, pattern):
+    if not write_extents(imagefile, [(offset, length, pattern)])[0]:
+        raise Exception("Failed to write pattern %i at %i+%i to %s" %
+                        (pattern, offset, length, imagefile))
 
-def verify_image(imagefile, offset, length, pattern):
-    assert os.path.exists(imagefile)
 
-    read_cmd = "read -P %i -s 0 -l %i %i %i" % (pattern, length, offset,
-                                                length)
-    cmd = ['qemu-io', '-c', read_cmd, imagefile]
-    output = subprocess.check_output(cmd)
-    if 'Pattern verification failed' in output:
-        return False
-    return True
+def verify_image(imagefile, offset, length, pattern):
+    return verify_extents(imagefile, [(offset, length, pattern)])[0]
 
 
+@timing.timed(timing.VERIFY)
 def verify_backing_file(imagePath, baseName, relative=False, block=False):
     if baseName:
         basePath = get_image_path(baseName, relative, block)
     else:
         basePath = None
-    cmd = ['qemu-img', 'info', imagePath]
-    output = subprocess.check_output(cmd)
-    m = re.search('^backing file: (\S*)', output, re.M)
-    if m:
-        baseMatch = m.group(1)
-    else:
-        baseMatch = None
-    return bool(basePath == baseMatch)
+    info = qcow2.read_image_info(imagePath, withEndOffset=False)
+    return bool(basePath == info.backingFile)
 
 
+@timing.timed(timing.VERIFY)
 def verify_image_format(imagePath, expectedFmt):
-    cmd = ['qemu-img', 'info', imagePath]
-    output = subprocess.check_output(cmd)
-    m = re.search('^file format: (\S*)', output, re.M)
-    if m:
-        return bool(m.group(1) == expectedFmt)
-    return False
+    info = qcow2.read_image_info(imagePath, withEndOffset=False)
+    return bool(info.format == expectedFmt)
 
 
 def get_image_end_offset(imagePath):
-    cmd = ['qemu-img', 'check', imagePath]
-    try:
-        output = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError, e:
-        print "qemu-img check returned error: %s" % e.output
-        output = e.output
-    m = re.search('^Image end offset: (\S*)', output, re.M)
-    return int(m.group(1))
+    return qcow2.read_image_info(imagePath).endOffset
+
+
+_eventLoopThread = None
+_eventLoopLock = threading.Lock()
+
+
+def start_event_loop():
+    """
+    Register the default libvirt event implementation and run it in a
+    daemon thread.  Only connections opened afterwards deliver events.
+    """
+    global _eventLoopThread
+    with _eventLoopLock:
+        if _eventLoopThread is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        _eventLoopThread = threading.Thread(target=run,
+                                            name='libvirt-events')
+        _eventLoopThread.daemon = True
+        _eventLoopThread.start()
 
 
 def libvirt_connect():
+    start_event_loop()
     return libvirt.open('qemu:///system')
 
 
-def wait_block_job(dom, path, jobType, timeout=10):
-    i = 0
-    while i < timeout:
-        info = dom.blockJobInfo(path, 0)
-        if not info:
-            return True
-        assert(info['type'] == jobType)
-        if info['cur'] == info['end']:
-            return True
-        time.sleep(1)
-        i = i + 1
-    return False
+_conn = None
+_connPid = None
+_connLock = threading.Lock()
 
 
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except libvirt.libvirtError:
+        pass
+
+
+def get_connection():
+    """
+    Return the libvirt connection shared by this process, opening it on
+    first use and reopening it if it is no longer alive.  A connection
+    inherited across fork belongs to the parent and is never reused.
+    """
+    global _conn, _connPid
+    with _connLock:
+        if _conn is not None and _connPid != os.getpid():
+            _conn = None
+        if _conn is not None:
+            try:
+                alive = _conn.isAlive()
+            except libvirt.libvirtError:
+                alive = False
+            if not alive:
+                _close_quietly(_conn)
+                _conn = None
+        if _conn is None:
+            _conn = libvirt_connect()
+            _connPid = os.getpid()
+        return _conn
+
+
+def close_connection():
+    global _conn
+    with _connLock:
+        if _conn is not None and _connPid == os.getpid():
+            _close_quietly(_conn)
+        _conn = None
+
+
+atexit.register(close_connection)
+
+
+class BlockJobResult(object):
+    """
+    Final state of a block job as seen by wait_block_job.  Evaluates to True
+    when the job completed or reached the ready (mirroring) phase.
+    """
+    def __init__(self, status, elapsed):
+        self.status = status
+        self.elapsed = elapsed
+
+    def __nonzero__(self):
+        return self.status in (libvirt.VIR_DOMAIN_BLOCK_JOB_COMPLETED,
+                               libvirt.VIR_DOMAIN_BLOCK_JOB_READY)
+
+    def __repr__(self):
+        return "BlockJobResult(status=%r, elapsed=%.3f)" % (self.status,
+                                                             self.elapsed)
+
+
+# Seconds between samples of the job size while waiting for events
+JOB_PROGRESS_INTERVAL = 0.5
+
+
+def _record_progress(info, progress):
+    if progress is not None:
+        progress['end'] = max(progress.get('end', 0), info['end'])
+
+
+def _block_job_status(dom, path, jobType, progress=None):
+    info = dom.blockJobInfo(path, 0)
+    if not info:
+        return libvirt.VIR_DOMAIN_BLOCK_JOB_COMPLETED
+    _record_progress(info, progress)
+    assert(info['type'] == jobType)
+    # A job that has not sized its work yet also reports cur == end == 0
+    if info['end'] and info['cur'] == info['end']:
+        return libvirt.VIR_DOMAIN_BLOCK_JOB_READY
+    return None
+
+
+def _disk_aliases(dom, path):
+    """
+    Block job events name the disk by its target while callers usually pass
+    the image path, so collect every name the disk is known by.
+    """
+    aliases = set([path])
+    root = ElementTree.fromstring(dom.XMLDesc(0))
+    for disk in root.findall('devices/disk'):
+        source = disk.find('source')
+        target = disk.find('target')
+        if source is None or target is None:
+            continue
+        names = set([source.get('file'), source.get('dev'),
+                     target.get('dev')])
+        if path in names:
+            aliases.update(names)
+    aliases.discard(None)
+    return aliases
+
+
+def _poll_block_job(dom, path, jobType, start, timeout, progress=None):
+    interval = 0.01
+    while True:
+        status = _block_job_status(dom, path, jobType, progress)
+        elapsed = time.time() - start
+        if status is not None or elapsed >= timeout:
+            return BlockJobResult(status, elapsed)
+        time.sleep(min(interval, timeout - elapsed))
+        interval = min(interval * 2, 1.0)
+
+
+@timing.timed(timing.JOB)
+def wait_block_job(dom, path, jobType, timeout=60.0):
+    """
+    Wait up to timeout seconds for the block job on path to complete or
+    become ready, using VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2 events when the
+    event loop is running and adaptive polling otherwise.
+
+    The amount of data the job had to copy, as far as it was seen before
+    the job went away, is added to the job_bytes metric of the test.  The
+    metric is left out if the job was never seen sized.
+    """
+    progress = {}
+    result = _wait_block_job(dom, path, jobType, timeout, progress)
+    if progress.get('end'):
+        timing.add_metric('job_bytes', progress['end'])
+    return result
+
+
+def _wait_block_job(dom, path, jobType, timeout, progress):
+    start = time.time()
+    if _eventLoopThread is None or not hasattr(dom, 'connect'):
+        return _poll_block_job(dom, path, jobType, start, timeout, progress)
+
+    aliases = _disk_aliases(dom, path)
+    statuses = []
+    finished = threading.Event()
+
+    def callback(conn, eventDom, disk, type, status, opaque):
+        if disk in aliases:
+            statuses.append(status)
+            finished.set()
+
+    conn = dom.connect()
+    try:
+        callbackId = conn.domainEventRegisterAny(
+            dom, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2, callback, None)
+    except libvirt.libvirtError:
+        return _poll_block_job(dom, path, jobType, start, timeout, progress)
+
+    try:
+        # The job may have finished before the callback was registered
+        status = _block_job_status(dom, path, jobType, progress)
+        if status is None:
+            # Sample the size of the job while it runs, a job that
+            # completes is gone by the time its event arrives
+            deadline = start + timeout
+            while not finished.is_set() and time.time() < deadline:
+                finished.wait(min(JOB_PROGRESS_INTERVAL,
+                                  max(0, deadline - time.time())))
+                info = dom.blockJobInfo(path, 0)
+                if info:
+                    _record_progress(info, progress)
+            if statuses:
+                status = statuses[0]
+                if status == libvirt.VIR_DOMAIN_BLOCK_JOB_READY:
+                    _block_job_status(dom, path, jobType, progress)
+    finally:
+        conn.domainEventDeregisterAny(callbackId)
+    return BlockJobResult(status, time.time() - start)
+
+
+@timing.timed(timing.VM_START)
 def create_vm(name, image_name, block=False):
     imagefile = get_image_path(image_name, relative=False, block=block)
+    if offline():
+        return fakedomain.FakeDomain(domain_name(name), imagefile)
     diskType, srcAttr = (('file', 'file'), ('block', 'dev'))[block]
     srcAttr
     xml = '''
@@ -196,37 +640,214 @@ def create_vm(name, image_name, block=False):
       </os>
       <devices>
         <disk type='%(diskType)s' device='disk'>
-          <driver name='qemu' type='qcow2' backing_format='qcow2'/>
+          <driver name='qemu' type='qcow2' backing_format='qcow2'
+                  %(driverAttrs)s/>
           <source %(srcAttr)s='%(imagefile)s' />
           <target dev='vda' bus='virtio' />
         </disk>
         <graphics type='vnc' />
       </devices>
     </domain>
-    ''' % {'name': name, 'imagefile': imagefile, 'diskType': diskType,
-           'srcAttr': srcAttr}
+    ''' % {'name': domain_name(name), 'imagefile': imagefile,
+           'diskType': diskType, 'srcAttr': srcAttr,
+           'driverAttrs': DISK_DRIVER_ATTRS}
 
-    conn = libvirt_connect()
+    conn = get_connection()
     return conn.createXML(xml, 0)
 
 
-def build_vm(image_name, script, size):
-    if not os.path.exists(IMAGEDIR):
-        os.mkdir(IMAGEDIR, 0755)
-
-    fname = get_image_path('BASE', False, False)
-    cmd = ['virt-builder', 'fedora-20', '--size', size, '-o', fname,
-           '--format', 'qcow2', '--root-password', 'password:passw0rd']
-    if script:
-        script_fd, script_file = tempfile.mkstemp()
-        os.write(script_fd, script)
-        os.close(script_fd)
-        cmd.extend(['--firstboot', script_file])
-
+GUEST_TEMPLATE = os.environ.get('LIVEMERGE_GUEST_TEMPLATE', 'fedora-20')
+GUEST_PASSWORD = 'passw0rd'
+# imagecache.COPY or imagecache.OVERLAY
+GUEST_CACHE_MODE = os.environ.get('LIVEMERGE_IMAGE_CACHE_MODE',
+                                  imagecache.COPY)
+GUEST_CACHE_SIZE = os.environ.get('LIVEMERGE_IMAGE_CACHE_SIZE', '50G')
+
+_guestCache = None
+
+
+def get_guest_cache():
+    global _guestCache
+    if _guestCache is None:
+        _guestCache = imagecache.GuestImageCache(
+            maxSize=parse_size(GUEST_CACHE_SIZE),
+            source=imagecache.TEMPLATE_SOURCE,
+            checkSignature=not imagecache.SKIP_SIGNATURE)
+    return _guestCache
+
+
+def domain_pool_enabled():
+    """
+    With LIVEMERGE_DOMAIN_POOL set, running_vm() hot-plugs test disks into
+    one long running domain per process instead of booting a domain per
+    test.
+    """
+    return bool(os.environ.get('LIVEMERGE_DOMAIN_POOL')) and not offline()
+
+
+class DomainPool(object):
+    """
+    A diskless domain kept running for the whole session, with test images
+    hot-plugged onto its virtio-scsi controller.  SCSI disks are removed
+    without guest cooperation, unlike virtio-blk PCI devices which need an
+    ACPI aware guest to complete an unplug.
+    """
+
+    TARGETS = ['sd%s' % c for c in 'abcdefghijklmnopqrstuvwxyz']
+    DETACH_TIMEOUT = 10.0
+
+    def __init__(self, name):
+        self._name = name
+        self._dom = None
+        self._targets = set()
+        self._lock = threading.Lock()
+
+    def _domain(self):
+        if self._dom is None or not self._dom.isActive():
+            xml = '''
+            <domain type='kvm'>
+              <name>%(name)s</name>
+              <memory unit='MiB'>256</memory>
+              <vcpu>1</vcpu>
+              <os>
+                <type arch='x86_64'>hvm</type>
+              </os>
+              <devices>
+                <controller type='scsi' index='0' model='virtio-scsi' />
+              </devices>
+            </domain>
+            ''' % {'name': self._name}
+            self._dom = get_connection().createXML(xml, 0)
+            self._targets = set()
+        return self._dom
+
+    def _disk_xml(self, imagefile, target, block):
+        diskType, srcAttr = (('file', 'file'), ('block', 'dev'))[block]
+        return '''
+        <disk type='%(diskType)s' device='disk'>
+          <driver name='qemu' type='qcow2' backing_format='qcow2'
+                  %(driverAttrs)s/>
+          <source %(srcAttr)s='%(imagefile)s' />
+          <target dev='%(target)s' bus='scsi' />
+        </disk>
+        ''' % {'diskType': diskType, 'srcAttr': srcAttr,
+               'imagefile': imagefile, 'target': target,
+               'driverAttrs': DISK_DRIVER_ATTRS}
+
+    def _attached(self, dom, target):
+        root = ElementTree.fromstring(dom.XMLDesc(0))
+        return any(t.get('dev') == target
+                   for t in root.findall('devices/disk/target'))
+
+    def attach(self, imagefile, block=False):
+        """
+        Hot-plug imagefile and return the domain and the disk target.
+        """
+        with self._lock:
+            dom = self._domain()
+            target = [t for t in self.TARGETS if t not in self._targets][0]
+            dom.attachDeviceFlags(self._disk_xml(imagefile, target, block),
+                                  libvirt.VIR_DOMAIN_AFFECT_LIVE)
+            self._targets.add(target)
+            return dom, target
+
+    def detach(self, target, imagefile, block=False):
+        """
+        Abort any block job left on target and unplug it.  The domain is
+        destroyed if the disk cannot be removed, so that the next test starts
+        from a clean domain.
+        """
+        with self._lock:
+            dom = self._dom
+            if dom is None or target not in self._targets:
+                return
+            try:
+                if dom.blockJobInfo(target, 0):
+                    dom.blockJobAbort(target, 0)
+                dom.detachDeviceFlags(self._disk_xml(imagefile, target, block),
+                                      libvirt.VIR_DOMAIN_AFFECT_LIVE)
+                deadline = time.time() + self.DETACH_TIMEOUT
+                while self._attached(dom, target):
+                    if time.time() >= deadline:
+                        raise libvirt.libvirtError(
+                            "Timed out detaching disk %s" % target)
+                    time.sleep(0.05)
+                self._targets.discard(target)
+            except libvirt.libvirtError:
+                self._destroy()
+                raise
+
+    def _destroy(self):
+        if self._dom is not None:
+            try:
+                self._dom.destroy()
+            except libvirt.libvirtError:
+                # Already gone, e.g. the connection was closed first
+                pass
+            self._dom = None
+            self._targets = set()
+
+    def destroy(self):
+        with self._lock:
+            self._destroy()
+
+
+_domainPool = None
+
+
+def get_domain_pool():
+    global _domainPool
+    if _domainPool is None:
+        _domainPool = DomainPool(domain_name('livemerge-pool'))
+    return _domainPool
+
+
+def destroy_domain_pool():
+    global _domainPool
+    if _domainPool is not None:
+        _domainPool.destroy()
+        _domainPool = None
+
+
+# Registered after close_connection so that it runs before it
+atexit.register(destroy_domain_pool)
+
+
+@contextmanager
+def running_vm(name, image_name, block=False, fresh=False):
+    """
+    Run image_name in a domain for the duration of the with block, yielding
+    the domain and the disk target of the image.  In domain pool mode the
+    image is hot-plugged into the pooled domain unless fresh is set, for
+    tests that need a clean boot.  The disk is always detached, or the
+    domain destroyed, when the block exits.
+    """
+    imagefile = get_image_path(image_name, relative=False, block=block)
+    if fresh or not domain_pool_enabled():
+        dom = create_vm(name, image_name, block)
+        try:
+            yield dom, 'vda'
+        finally:
+            dom.destroy()
+        return
+
+    pool = get_domain_pool()
+    with timing.phase(timing.VM_START):
+        dom, target = pool.attach(imagefile, block)
     try:
-        my_env = os.environ.copy()
-        my_env['LIBGUESTFS_BACKEND'] = 'direct'
-        subprocess.check_call(cmd, env=my_env)
+        yield dom, target
     finally:
-        if script:
-            os.unlink(script_file)
+        with timing.phase(timing.TEARDOWN):
+            pool.detach(target, imagefile, block)
+
+
+@timing.timed(timing.SETUP)
+def build_vm(image_name, script, size):
+    """
+    Create image_name from a guest image built by virt-builder, reusing a
+    cached build of the same template, size, password and script.
+    """
+    _makedirs(IMAGEDIR)
+    fname = get_image_path(image_name, False, False)
+    get_guest_cache().get(GUEST_TEMPLATE, size, GUEST_PASSWORD, script,
+                          fname, GUEST_CACHE_MODE)
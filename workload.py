@@ -0,0 +1,110 @@
+import os
+from collections import namedtuple
+
+SEQUENTIAL = 'sequential'
+RANDOM = 'random'
+
+# O_DIRECT needs buffers, offsets and lengths aligned to the logical block
+# size of the guest disk; a page covers every disk we use.
+ALIGNMENT = 4096
+
+# Guest I/O workload run from the firstboot script of the test VM.
+#   rate:        MiB written per second; reads come on top of it
+#   blockSize:   bytes per request, a multiple of ALIGNMENT
+#   pattern:     SEQUENTIAL or RANDOM offsets within the working set
+#   readPercent: share of requests that are reads, 0 to 99
+#   workingSet:  MiB of the guest file the requests are spread over
+Workload = namedtuple('Workload',
+                      'rate blockSize pattern readPercent workingSet')
+
+GUEST_FILE = '/blob'
+
+SCRIPT = '''#!/bin/bash
+exec python - <<'EOF'
+import mmap
+import os
+import random
+import time
+
+rate = %(rate)d * 1024 * 1024
+blockSize = %(blockSize)d
+randomOffsets = %(random)r
+readPercent = %(readPercent)d
+blocks = %(workingSet)d * 1024 * 1024 / blockSize
+
+fd = os.open(%(path)r, os.O_RDWR | os.O_CREAT | os.O_DIRECT, 0644)
+f = os.fdopen(fd, 'r+b', 0)
+buf = mmap.mmap(-1, blockSize)
+buf.write(os.urandom(blockSize))
+start = time.time()
+done = 0
+block = 0
+while True:
+    if randomOffsets:
+        block = random.randrange(blocks)
+    else:
+        block = (block + 1) %% blocks
+    f.seek(block * blockSize)
+    if random.randrange(100) < readPercent:
+        f.readinto(buf)
+        continue
+    f.write(buf)
+    done += blockSize
+    delay = start + float(done) / rate - time.time()
+    if delay > 0:
+        time.sleep(delay)
+EOF
+'''
+
+
+def workload(rate=100, blockSize=1024 * 1024, pattern=SEQUENTIAL,
+             readPercent=0, workingSet=6144):
+    """
+    Build a Workload, checking it can be run as O_DIRECT I/O.
+    """
+    if blockSize <= 0 or blockSize % ALIGNMENT:
+        raise ValueError("Block size must be a multiple of %i" % ALIGNMENT)
+    if pattern not in (SEQUENTIAL, RANDOM):
+        raise ValueError("Invalid pattern: %s" % pattern)
+    # The rate paces writes, a workload needs some to be paced at all
+    if not 0 <= readPercent < 100:
+        raise ValueError("Invalid read percentage: %s" % readPercent)
+    if workingSet * 1024 * 1024 < blockSize:
+        raise ValueError("Working set smaller than one block")
+    return Workload(rate, blockSize, pattern, readPercent, workingSet)
+
+
+def from_env(prefix='LIVEMERGE_WORKLOAD_', **defaults):
+    """
+    Build a Workload from LIVEMERGE_WORKLOAD_RATE, _BLOCK_SIZE, _PATTERN,
+    _READ_PERCENT and _WORKING_SET, falling back to defaults.
+    """
+    fields = (('rate', 'RATE', int), ('blockSize', 'BLOCK_SIZE', int),
+              ('pattern', 'PATTERN', str),
+              ('readPercent', 'READ_PERCENT', int),
+              ('workingSet', 'WORKING_SET', int))
+    kwargs = dict(defaults)
+    for field, name, convert in fields:
+        value = os.environ.get(prefix + name)
+        if value:
+            kwargs[field] = convert(value)
+    return workload(**kwargs)
+
+
+def render(spec):
+    """
+    Render spec as a firstboot script.  The guest writes whole blocks with
+    O_DIRECT so every write reaches the disk and dirties the image.  Only
+    writes are paced to the rate, so it compares with the write rate seen
+    on the host.
+    """
+    return SCRIPT % {'rate': spec.rate, 'blockSize': spec.blockSize,
+                     'random': spec.pattern == RANDOM,
+                     'readPercent': spec.readPercent,
+                     'workingSet': spec.workingSet, 'path': GUEST_FILE}
+
+
+def describe(spec):
+    return '%iMiB/s %s %iK %i%%r ws=%iM' % (
+        spec.rate, spec.pattern, spec.blockSize / 1024, spec.readPercent,
+        spec.workingSet)